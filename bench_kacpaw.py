@@ -0,0 +1,225 @@
+# Offline benchmarks for KACPAW
+
+"""
+Benchmarks KACPAW against kacpaw.testing.FakeKA, so no network is needed.
+
+For each operation, this reports how many requests it sends, p50 and p99
+latency and throughput.  Every operation has a request budget, and if one
+goes over, the script exits with an error, so request count regressions
+don't go unnoticed.  test_kacpaw.py also checks the budgets.
+
+``--accessors`` runs a microbenchmark of reading ``meta_path_map`` items
+out of metadata instead, comparing the compiled getters to the old
+recursive ``get_dict_path``.
+
+Run ``python bench_kacpaw.py --help`` for options.
+"""
+
+import argparse
+import itertools
+import math
+import sys
+import time
+import timeit
+from collections import namedtuple
+
+from kacpaw import *
+from kacpaw.ratelimit import RateLimiter
+from kacpaw.testing import FakeKA
+from kacpaw.utils import get_dict_path
+
+
+BenchResult = namedtuple("BenchResult",
+    ["name", "operations", "requests_per_op", "budget", "p50", "p99", "throughput"])
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class Benchmarks:
+    """
+    The benchmarked operations.  Each ``bench_*`` method returns a function
+    that runs the operation once and the most requests it should send.
+    """
+    def __init__(self, fake, comments=100, replies=20):
+        self.fake = fake
+        self.comments = comments
+        self.replies = replies
+
+        bot = fake.add_user("bench_bot", "password")
+        self.program_id = fake.add_program(title="Benchmark", code="// code\n" * 1000,
+            author=bot, comments=comments, replies=replies)
+        self.comment_key = fake.program_comments[self.program_id][0]
+        self.reply_keys = fake.replies[self.comment_key]
+
+        self.transport = fake.install(Transport())
+        # a limiter that never makes us wait, so we time kacpaw and not it
+        self.session = fake.session("bench_bot", "password",
+            rate_limiter=RateLimiter(rate=1e6))
+
+    def program(self):
+        program = Program(self.program_id)
+        program.transport = self.transport
+        return program
+
+    def bench_property_reads(self):
+        def operation():
+            program = self.program()
+            for name in ["title", "code", "width", "height", "kind", "url", "image_url"]:
+                getattr(program, name)
+        return operation, 1
+
+    def bench_reply_pagination(self):
+        def operation():
+            for comment_data in self.program().get_reply_data():
+                pass
+        return operation, math.ceil(self.comments / Program.reply_params["limit"])
+
+    def bench_reply_pagination_big_pages(self):
+        def operation():
+            for comment_data in self.program().get_reply_data(page_size=100):
+                pass
+        return operation, math.ceil(self.comments / 100)
+
+    def bench_thread_reads(self):
+        def operation():
+            comment = ProgramComment(self.comment_key, self.program())
+            for reply in comment.get_replies():
+                reply.text_content
+        return operation, 1
+
+    def bench_reply_lookup(self):
+        def operation():
+            # a reply we know nothing about, so we have to find its parent
+            reply = ProgramCommentReply(self.reply_keys[-1], self.program())
+            reply.text_content
+        # find the parent, check that the reply exists, get the thread
+        return operation, 3
+
+    def bench_edit(self):
+        edit_numbers = itertools.count()
+        def operation():
+            self.program().edit(self.session,
+                title="Benchmark (edit {})".format(next(edit_numbers)))
+        return operation, 2
+
+    def bench_edit_unchanged(self):
+        def operation():
+            self.program().edit(self.session, title="Benchmark", width=400)
+        return operation, 1
+
+    def bench_edit_cached(self):
+        def operation():
+            program = self.program()
+            program.title # the metadata gets cached here
+            program.edit(self.session, title="Benchmark (edited)")
+            program.edit(self.session, title="Benchmark")
+        # one read, two edits, and one more read since the first edit
+        # invalidates the cache
+        return operation, 4
+
+    def run(self, name, repeat=20):
+        operation, budget = getattr(self, "bench_" + name)()
+        latencies = []
+
+        self.fake.reset_requests()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            op_started = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - op_started)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        return BenchResult(name, repeat, self.fake.request_count / repeat, budget,
+            percentile(latencies, 0.5), percentile(latencies, 0.99), repeat / elapsed)
+
+    def names(self):
+        return [name[len("bench_"):] for name in dir(self) if name.startswith("bench_")]
+
+    def run_all(self, repeat=20):
+        return [self.run(name, repeat) for name in self.names()]
+
+
+def recursive_get_dict_path(base, path):
+    """How get_dict_path used to work, for comparison"""
+    path = list(path)
+    level = path.pop(0)
+
+    if path:
+        return recursive_get_dict_path(base[level], path)
+    return base[level]
+
+def accessor_benchmarks(number=200000):
+    """
+    Times ways of getting ``meta_path_map`` items out of program metadata,
+    returning a list of (name, nanoseconds per call) pairs.
+    """
+    metadata = Program("0")._fix_metadata({
+        "title": "Benchmark", "width": 400, "imageUrl": "image.png",
+        "revision": {"code": "// code", "id": "1"}
+    })
+    path_map = Program.meta_path_map
+    names = ("title", "code", "image_url")
+    getters = [Program._meta_getters[name] for name in names]
+    get_all = Program.meta_getter(*names)
+
+    cases = [
+        ("recursive get_dict_path", lambda: recursive_get_dict_path(metadata, path_map["code"])),
+        ("get_dict_path", lambda: get_dict_path(metadata, path_map["code"])),
+        ("compiled getter", lambda: Program._meta_getters["code"](metadata)),
+        ("3 items, recursive", lambda: tuple(
+            recursive_get_dict_path(metadata, path_map[name]) for name in names)),
+        ("3 items, compiled getters", lambda: tuple(getter(metadata) for getter in getters)),
+        ("3 items, meta_getter", lambda: get_all(metadata)),
+    ]
+    return [(name, min(timeit.repeat(case, number=number, repeat=3)) / number * 1e9)
+        for name, case in cases]
+
+def print_results(results, file=sys.stdout):
+    row = "{:<28} {:>10} {:>8} {:>10} {:>10} {:>10}"
+    print(row.format("operation", "requests", "budget", "p50 (ms)", "p99 (ms)", "ops/s"), file=file)
+    for result in results:
+        print(row.format(
+            result.name, "{:.2f}".format(result.requests_per_op), result.budget,
+            "{:.2f}".format(result.p50 * 1000), "{:.2f}".format(result.p99 * 1000),
+            "{:.1f}".format(result.throughput)
+        ), file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="seconds the fake server takes for each request")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+        help="chance that each request fails with a 503")
+    parser.add_argument("--comments", type=int, default=100)
+    parser.add_argument("--replies", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20,
+        help="how many times each operation is run")
+    parser.add_argument("--accessors", action="store_true",
+        help="run the meta_path_map accessor microbenchmark instead")
+    parser.add_argument("only", nargs="*", help="names of benchmarks to run")
+    args = parser.parse_args(argv)
+
+    if args.accessors:
+        for name, nanoseconds in accessor_benchmarks():
+            print("{:<28} {:>8.1f} ns".format(name, nanoseconds))
+        return 0
+
+    with FakeKA(latency=args.latency, error_rate=args.error_rate, seed=0) as fake:
+        benchmarks = Benchmarks(fake, args.comments, args.replies)
+        results = [benchmarks.run(name, args.repeat) for name in args.only or benchmarks.names()]
+
+    print_results(results)
+    over_budget = [result.name for result in results if result.requests_per_op > result.budget]
+    if over_budget:
+        print("\nOver the request budget:", ", ".join(over_budget), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
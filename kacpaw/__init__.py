@@ -4,4 +4,7 @@ KACPAW
 
 from .content import *
 from .sessions import *
+from .transport import Transport
+from .cache import ResponseCache, IdentifierCache
+from .tracing import trace
 import kacpaw.content_abcs as abcs
\ No newline at end of file
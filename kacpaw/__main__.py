@@ -0,0 +1,41 @@
+"""
+Command line tools for KACPAW.  Run ``python -m kacpaw --help`` for help.
+"""
+
+import argparse
+import sys
+
+from kacpaw.content import Program
+from kacpaw.export import export_to_file
+
+
+def export(args):
+    written = export_to_file(Program(args.program_id), args.output, resume=not args.restart,
+        workers=args.workers, page_size=args.page_size)
+    print("Wrote {} comments and replies to {}".format(written, args.output), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m kacpaw")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    export_parser = commands.add_parser("export",
+        help="export the discussion on a program as json lines")
+    export_parser.add_argument("program_id")
+    export_parser.add_argument("output", help="the file to write to.  "
+        "If it has an unfinished export in it, the export is resumed")
+    export_parser.add_argument("--workers", type=int, default=4,
+        help="how many threads of replies to download at once")
+    export_parser.add_argument("--page-size", type=int, default=None,
+        help="how many comments to request at once")
+    export_parser.add_argument("--restart", action="store_true",
+        help="start over instead of resuming")
+    export_parser.set_defaults(func=export)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
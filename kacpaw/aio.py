@@ -0,0 +1,616 @@
+"""
+asyncio versions of KASession and the content classes
+
+The classes here subclass the normal content classes, so they use the same
+urls and ``meta_path_map``s, but anything that sends a request is a
+coroutine (or an async generator) instead::
+
+    async with AsyncKASession(username, password) as session:
+        program = AsyncProgram("4617827881975808")
+        print(await program.title)
+
+        async for comment in program.get_replies():
+            await comment.reply(session, "Hello!")
+
+Things that are built on threads or on ``requests`` raise NotImplementedError
+on async content.  Those are ``AsyncProgram``'s ``paginate_replies`` (use
+``get_reply_data``, which takes the same arguments), ``export_discussion``
+and ``iter_new_replies``.  Use the normal content classes for them.
+
+This needs aiohttp, which isn't installed along with KACPAW, so install it
+(``pip install KACPAW[async]``) if you want to use this module.
+"""
+
+import asyncio
+import copy
+import json
+import time
+
+try:
+    import aiohttp
+except ImportError: # we'll complain once somebody actually tries to use it
+    aiohttp = None
+
+import kacpaw.content_abcs as abcs
+import kacpaw.tracing as tracing
+from kacpaw.content import (
+    User, ProgramComment, ProgramCommentReply, Program,
+    CommentThread, _CommentDoesntExistError
+)
+from kacpaw.projection import project
+from kacpaw.utils import KA_DOMAIN, kaurl, method
+
+
+class AsyncTransport:
+    """
+    Sends requests to KA using aiohttp.
+
+    Besides pooling connections, a transport limits how many requests can be
+    in flight at once and, optionally, how many are started each second, so
+    you can throw thousands of coroutines at it without KA getting upset.
+    """
+    # If this is set (to something like "http://127.0.0.1:8000"), requests for
+    # KA go there instead.  kacpaw.testing.FakeKA.install sets it.
+    base_url = None
+
+    def __init__(self, limit=100, rate=None, pool_size=100, timeout=None,
+                 user_agent="Ben-Burrill-Bot Python", coalesce=True):
+        """
+        ``limit`` is the maximum number of requests that can be in flight at
+        once, ``rate`` is the maximum number of requests started per second
+        (or None for no maximum) and ``pool_size`` is the maximum number of
+        open connections.  ``timeout`` is the total timeout, in seconds, for
+        each request.
+
+        If ``coalesce`` is true, coroutines that GET the same url while a
+        request for it is already in flight wait for that request instead of
+        sending their own.
+        """
+        self.limit = limit
+        self.coalesce = coalesce
+        self.rate = rate
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = {"User-Agent": user_agent}
+
+        # aiohttp sessions and asyncio primitives belong to a single event
+        # loop, so we make them when they are first needed and remake them
+        # if we find ourselves in a different loop.
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+        self._rate_lock = None
+        self._next_start = 0
+        self._in_flight = {} # (url, params) -> task getting the body
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            if aiohttp is None:
+                raise ImportError("kacpaw.aio needs aiohttp to send requests")
+            self._loop = loop
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                # by default, aiohttp ignores cookies from ip addresses, which
+                # is what a base_url usually is
+                cookie_jar=aiohttp.CookieJar(unsafe=self.base_url is not None)
+            )
+            self._semaphore = asyncio.Semaphore(self.limit)
+            self._rate_lock = asyncio.Lock()
+            self._in_flight = {}
+        return self._session
+
+    async def _wait_for_rate(self):
+        if self.rate is None:
+            return
+        async with self._rate_lock:
+            now = time.monotonic()
+            if self._next_start > now:
+                await asyncio.sleep(self._next_start - now)
+                now = self._next_start
+            self._next_start = now + 1 / self.rate
+
+    def _url(self, url):
+        if self.base_url is not None and url.startswith(KA_DOMAIN):
+            return self.base_url + url[len(KA_DOMAIN):]
+        return url
+
+    async def request_json(self, method, url, **kwargs):
+        """
+        Sends a request, returning its parsed json body (or None if the body
+        was empty).  Errors statuses raise an ``aiohttp.ClientResponseError``.
+        """
+        return self._parse(await self._request_body(method, url, **kwargs))
+
+    async def send(self, method, url, **kwargs):
+        """
+        Like ``request_json``, but ignores the body, so it can be used for
+        pages that aren't json.
+        """
+        await self._request_body(method, url, **kwargs)
+
+    @staticmethod
+    def _parse(body):
+        return json.loads(body.decode("utf-8")) if body else None
+
+    async def _request_body(self, method, url, **kwargs):
+        session = self._get_session()
+        async with self._semaphore:
+            await self._wait_for_rate()
+            started = time.monotonic()
+            async with session.request(method, self._url(url),
+                    headers=self.headers, **kwargs) as resp:
+                body = await resp.read()
+                tracing.record(method, str(resp.url), resp.status, len(body),
+                    time.monotonic() - started)
+                resp.raise_for_status()
+        return body
+
+    async def get_json(self, url, **kwargs):
+        """Sends a GET request, returning its parsed json body"""
+        if not self.coalesce or kwargs.keys() - {"params"}:
+            return await self.request_json("GET", url, **kwargs)
+
+        self._get_session() # make sure _in_flight belongs to this loop
+        key = (url, tuple(sorted((kwargs.get("params") or {}).items())))
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = asyncio.ensure_future(
+                self._request_body("GET", url, **kwargs))
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        # Everybody gets their own parsed copy, since content likes to
+        # modify what it gets.  The shield keeps one waiter getting
+        # cancelled from cancelling the request for everyone else.
+        return self._parse(await asyncio.shield(task))
+
+    async def close(self):
+        """Closes all pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncKASession(AsyncTransport):
+    """
+    An ``AsyncTransport`` that is logged into KA
+
+    Since logging in sends requests, it can't happen in ``__init__``.  Either
+    use the session with ``async with``, which logs in with the credentials
+    given to ``__init__``, or ``await session.login(username, password)``.
+    """
+    def __init__(self, username=None, password=None, **kwargs):
+        """
+        ``kwargs`` are passed to ``AsyncTransport``.
+        """
+        super().__init__(**kwargs)
+        self._credentials = (username, password)
+        self.user = None
+        self.user_data = None
+
+    async def __aenter__(self):
+        username, password = self._credentials
+        if username is not None:
+            await self.login(username, password)
+        return self
+
+    async def login(self, username, password):
+        session = self._get_session()
+        # the login page is html, not json
+        await self.send("GET", kaurl("login"))
+
+        # same deal as KASession.login - the fkey comes from a cookie
+        fkey = self.headers["x-ka-fkey"] = next(
+            cookie.value for cookie in session.cookie_jar
+            if cookie.key == "fkey"
+        )
+        await self.send("POST", kaurl("login"), data={
+            "identifier": username,
+            "password": password,
+            "fkey": fkey
+        })
+
+        self.user_data = None
+        self.user = AsyncUser(await self.get_user_id())
+        self.user.transport = self
+
+    async def get_user_data(self):
+        """
+        Gets the logged in user's data from api/v1/user.  It's cached (as
+        ``user_data``) until the next login.
+        """
+        if self.user_data is None:
+            self.user_data = await self.get_json(kaurl("api/v1/user"))
+        return self.user_data
+
+    async def get_user_id(self):
+        """Gets the user id of the logged in user"""
+        return (await self.get_user_data())["kaid"]
+
+
+# The transport used by async content unless something else is set.  Just
+# like in kacpaw.transport, set ``transport`` on a class or object to change it
+default_transport = AsyncTransport()
+
+
+def _not_async(name, alternative):
+    """Makes a method that says ``name`` doesn't work on async content"""
+    def not_async(self, *args, **kwargs):
+        raise NotImplementedError("{} doesn't work on async content.  {}".format(
+            name, alternative))
+    not_async.__name__ = name
+    return not_async
+
+
+async def fetch_many(contents, workers=8, fields=None):
+    """
+    Async version of ``kacpaw.content_abcs.fetch_many``.  Yields a
+    ``FetchResult`` for each piece of async content in ``contents`` as soon
+    as it's done, with up to ``workers`` requests in flight at once.
+    """
+    semaphore = asyncio.Semaphore(workers)
+
+    async def fetch(content):
+        async with semaphore:
+            try:
+                if fields is not None:
+                    return abcs.FetchResult(content, await content.get_fields(*fields), None)
+                return abcs.FetchResult(content, await content.get_metadata(), None)
+            except Exception as error: # one bad id shouldn't ruin the whole batch
+                return abcs.FetchResult(content, None, error)
+
+    for result in asyncio.as_completed([fetch(content) for content in contents]):
+        yield await result
+
+
+def _make_async_item_getter(cls, item_name):
+    """
+    Like content_abcs._make_item_getter, but the property gives an awaitable,
+    so you use ``await program.title`` instead of ``program.title``.
+    """
+    @method(cls, item_name)
+    async def get_meta_item(self):
+        metadata = self._fresh_metadata()
+        if metadata is None:
+            # same unloaded policy as synchronous content
+            found, value = self._cached_unloaded_item(item_name)
+            if found:
+                return value
+            metadata = await self.get_metadata()
+        return self._meta_getters[item_name](metadata)
+
+    get_meta_item.__doc__ = "Gets ``{item_name}`` from ``{cls.__name__}`` (awaitable)".format(
+        cls=cls, item_name=item_name
+    )
+
+    return property(get_meta_item)
+
+
+class AsyncMetaPathMapClass(abcs.MetaPathMapClass):
+    """
+    Metaclass for async content.
+
+    The normal metaclass only makes getters for names that don't exist yet,
+    but async content inherits its synchronous getters, so we replace them.
+    """
+    def __init__(cls, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for item_name in cls.meta_path_map:
+            if item_name not in vars(cls):
+                setattr(cls, item_name, _make_async_item_getter(cls, item_name))
+
+
+class AsyncContent(abcs.Content, metaclass=AsyncMetaPathMapClass):
+    """
+    Base class for async content.  It should come before the synchronous
+    content class it is based on, like ``class AsyncProgram(AsyncContent,
+    Program)``.
+    """
+    transport = default_transport
+
+    async def get_metadata(self):
+        """Gets the content's metadata as a dict, using the cache if it's fresh"""
+        metadata = self._fresh_metadata()
+        if metadata is not None:
+            return metadata
+
+        metadata = await self.fetch_metadata()
+        self._cache_metadata(metadata)
+        return metadata
+
+    async def fetch_metadata(self):
+        """Requests the content's metadata from KA, ignoring the cache"""
+        return await self.transport.get_json(self.api_get)
+
+    async def refresh(self):
+        """Throws away cached metadata and gets it again"""
+        self.invalidate()
+        return await self.get_metadata()
+
+    async def load(self):
+        """Async version of ``Content.load``"""
+        await self.get_metadata()
+        return self
+
+    async def get_fields(self, *names):
+        """
+        Async version of ``Content.get_fields``.  The response isn't streamed
+        like it is for synchronous content, but only the items ``names`` are
+        kept.
+        """
+        metadata = self._fresh_metadata()
+        if metadata is None:
+            return await self.fetch_fields(names)
+        return project(metadata, self._field_paths(names, self.meta_path_map))
+
+    async def fetch_fields(self, names):
+        """Async version of ``Content.fetch_fields``"""
+        # fetch_metadata already put everything where meta_path_map says
+        return project(await self.fetch_metadata(),
+            self._field_paths(names, self.meta_path_map))
+
+    async def prefetch(self, *names):
+        """Async version of ``Content.prefetch``"""
+        if not self._metadata_is_fresh():
+            self._cache_fields(await self.get_fields(*names))
+        return self
+
+    async def edit(self, session, **kwargs):
+        """
+        Async version of ``Editable.edit``.  Like it, edits that wouldn't
+        change anything aren't sent, and it returns whether one was.
+        """
+        metadata = await self.get_metadata()
+        if all(self._has_value(metadata, name, value) for name, value in kwargs.items()):
+            return False
+
+        # copy so that a failed edit doesn't leave junk in the cache
+        metadata = copy.deepcopy(metadata)
+        for name, value in kwargs.items():
+            self._meta_setters[name](metadata, value)
+
+        await session.request_json(self.api_edit_method, self.api_edit, json=metadata)
+        self.invalidate()
+        return True
+
+    async def delete(self, session):
+        """Async version of ``Deletable.delete``"""
+        await session.request_json("DELETE", self.api_delete)
+        self.invalidate()
+
+    async def reply(self, session, message, topic="computer-programming"):
+        """Async version of ``Replyable.reply``"""
+        data = await session.request_json("POST", self.api_reply, json={
+            "text": message,
+            "topic_slug": topic
+        })
+        self.invalidate()
+        return self.reply_type(data["key"], self)
+
+    async def get_replies(self, **kwargs):
+        """
+        Async version of ``Replyable.get_replies``.  Like the synchronous
+        ``get_replies``, the replies' data is cached as their metadata.
+        ``kwargs`` go to ``get_reply_data``.
+        """
+        async for reply_data in self.get_reply_data(**kwargs):
+            reply = self.reply_type(reply_data["key"], self)
+            reply._cache_metadata(reply_data)
+            yield reply
+
+
+class AsyncUser(AsyncContent, User):
+    """Async version of ``User``"""
+    @classmethod
+    def fetch_many(cls, ka_ids, workers=8, fields=None):
+        """
+        Gets the metadata of the users with the ka_ids ``ka_ids``
+        concurrently.  See ``kacpaw.aio.fetch_many``.
+        """
+        return fetch_many(map(cls, ka_ids), workers, fields)
+
+    @classmethod
+    async def _from_identifier(cls, identifier_kind, identifier):
+        # see User._from_identifier.  There's no need for User._lookups,
+        # since the transport coalesces identical requests already.
+        cache = cls.identifier_cache
+        cached = None if cache is None else cache.get(identifier_kind, identifier)
+        if cached is None:
+            profile = await cls.transport.get_json(cls.get_user, params={
+                identifier_kind: identifier
+            })
+            if cache is not None:
+                cache.put(identifier_kind, identifier, profile)
+            cached = profile, time.time()
+        profile, downloaded = cached
+
+        user = cls(profile["kaid"])
+        user._cache_metadata(profile, time.monotonic() - (time.time() - downloaded))
+        return user
+
+    @classmethod
+    async def from_username(cls, username):
+        """Gets a user by their username"""
+        return await cls._from_identifier("username", username)
+
+    @classmethod
+    async def from_email(cls, email):
+        """Gets a user by thier email"""
+        return await cls._from_identifier("email", email)
+
+    @classmethod
+    async def from_usernames(cls, usernames, workers=8):
+        """Async version of ``User.from_usernames``"""
+        semaphore = asyncio.Semaphore(workers)
+
+        async def lookup(username):
+            async with semaphore:
+                try:
+                    user = await cls.from_username(username)
+                except Exception as error:
+                    return username, abcs.FetchResult(None, None, error)
+                return username, abcs.FetchResult(user, user._metadata, None)
+
+        return dict(await asyncio.gather(*map(lookup, set(usernames))))
+
+
+class AsyncProgramComment(AsyncContent, ProgramComment):
+    """Async version of ``ProgramComment``"""
+    reply_type = property(lambda _: AsyncProgramCommentReply)
+
+    async def _comment_exists(self):
+        # see ProgramComment._comment_exists.  api_reply is the url that
+        # Comment.get_reply_data would use.
+        try:
+            await self.transport.get_json(self.api_reply)
+        except aiohttp.ClientResponseError:
+            return False
+        return True
+
+    async def fetch_metadata(self):
+        feedback = (await super().fetch_metadata())["feedback"]
+        if not feedback:
+            raise _CommentDoesntExistError(self)
+        data = feedback[0]
+        # see ProgramComment.fetch_metadata
+        if data["key"] == self.id or not self.check_exists:
+            return data
+        if await self._comment_exists():
+            return data
+        raise _CommentDoesntExistError(self)
+
+    async def get_thread(self, refresh=False):
+        """Async version of ``ProgramComment.get_thread``"""
+        thread = self._thread
+        if refresh or thread is None or not thread.is_fresh(self.metadata_ttl):
+            thread = CommentThread(await self.transport.get_json(self.api_reply))
+            if self.metadata_ttl != 0:
+                self._thread = thread
+        return thread
+
+    async def get_reply_data(self):
+        """Yields data about the replies to this comment"""
+        for reply in (await self.get_thread()).replies:
+            yield reply
+
+    async def _get_url(self):
+        return "{}?qa_expand_key={}".format(await self.get_program().url, self.id)
+
+    url = property(_get_url, doc="The comment's url (awaitable)")
+
+    async def get_author(self):
+        """Returns the ``AsyncUser`` who wrote the comment."""
+        return self._share_transport(AsyncUser((await self.get_metadata())["authorKaid"]))
+
+    def get_program(self):
+        """Returns the ``AsyncProgram`` that the comment was posted on."""
+        return self._share_transport(AsyncProgram(self.program_id))
+
+    get_parent = get_program
+
+    async def edit(self, session, message):
+        """See ``ProgramComment.edit``"""
+        metadata = self._fresh_metadata()
+        if metadata is not None and self._has_value(metadata, "text_content", message):
+            return False
+
+        await session.request_json("PUT", self.api_edit, json={
+            "text": message
+        })
+        self.invalidate()
+        return True
+
+
+class AsyncProgramCommentReply(AsyncProgramComment, ProgramCommentReply):
+    """Async version of ``ProgramCommentReply``"""
+    async def reply(self, session, message):
+        """See ``ProgramCommentReply.reply``"""
+        metadata = await self.get_metadata()
+        return await (await self.get_parent()).reply(session,
+            "@{metadata[authorNickname]}: {message}".format(
+                metadata=metadata, message=message
+            )
+        )
+
+    async def get_parent(self):
+        """Returns the ``AsyncProgramComment`` that started the thread."""
+        # see ProgramCommentReply.get_parent
+        if self._parent is None:
+            data = await AsyncProgramComment.fetch_metadata(self)
+            self._parent = AsyncProgramComment(data["key"], self)
+            self._parent_confirmed = True
+        return self._parent
+
+    async def _get_thread(self):
+        """Async version of ``ProgramCommentReply._get_thread``"""
+        thread = await (await self.get_parent()).get_thread()
+        if self.id not in thread:
+            thread = await (await self.get_parent()).get_thread(refresh=True)
+
+        if self.id not in thread and not self._parent_confirmed:
+            self._parent = None
+            thread = await (await self.get_parent()).get_thread()
+
+        if self.id not in thread:
+            raise _CommentDoesntExistError(self)
+        return thread
+
+    async def fetch_metadata(self):
+        return (await self._get_thread())[self.id]
+
+    async def get_reply_data(self):
+        """Yields data about all replies that were posted after this one."""
+        for comment_data in (await self._get_thread()).after(self.id):
+            yield comment_data
+
+
+class AsyncProgram(AsyncContent, Program):
+    """Async version of ``Program``"""
+    reply_type = AsyncProgramComment
+
+    @classmethod
+    def fetch_many(cls, program_ids, workers=8, fields=None):
+        """
+        Gets the metadata of the programs with the ids ``program_ids``
+        concurrently.  See ``kacpaw.aio.fetch_many``.
+        """
+        return fetch_many(map(cls, program_ids), workers, fields)
+
+    paginate_replies = _not_async("paginate_replies",
+        "get_reply_data takes the same arguments, except for prefetch.")
+    export_discussion = _not_async("export_discussion", "Use a Program instead.")
+    iter_new_replies = _not_async("iter_new_replies", "Use a Program instead.")
+
+    async def fetch_metadata(self):
+        return self._fix_metadata(await super().fetch_metadata())
+
+    async def get_reply_data(self, page_size=None, cursor=None, max_items=None, **params):
+        """
+        Yields data about the comments on this program.  The arguments are the
+        same as for ``Program.paginate_replies``, except there's no prefetching.
+        """
+        params = dict(self.reply_params, **params)
+        if page_size is not None:
+            params["limit"] = page_size
+
+        count = 0
+        while True:
+            if cursor is not None:
+                params["cursor"] = cursor
+            data = await self.transport.get_json(self.api_reply, params=params)
+
+            for comment_data in data["feedback"]:
+                if max_items is not None and count >= max_items:
+                    return
+                count += 1
+                yield comment_data
+
+            if data["isComplete"]:
+                return
+            cursor = data["cursor"]
@@ -0,0 +1,279 @@
+"""
+A persistent cache of KA's responses, for use with ``kacpaw.Transport``
+
+Responses are stored in an SQLite database along with their ETag and
+Last-Modified headers.  When a cached url is requested again, the transport
+sends a conditional request, and if KA says nothing has changed (304), the
+cached body is used instead of downloading it again.
+
+There's also ``IdentifierCache``, which remembers which kaids usernames and
+emails belong to.
+"""
+
+import collections
+import copy
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class CacheMissError(requests.ConnectionError):
+    """
+    Raised by an offline cache's transport when a url isn't in the cache.  It
+    is a ``requests.ConnectionError``, since that's what you would get if
+    you were really offline.
+    """
+    def __init__(self, url):
+        super().__init__("{} is not in the offline response cache".format(url))
+        self.url = url
+
+
+CachedResponse = collections.namedtuple("CachedResponse",
+    ["url", "body", "etag", "last_modified", "content_type"])
+
+
+class ResponseCache:
+    """
+    An SQLite-backed store of response bodies, keyed by url.
+
+    Entries are evicted least-recently-used first once the bodies add up to
+    more than ``max_size`` bytes.
+    """
+    def __init__(self, path, max_size=None, offline=False):
+        """
+        ``path`` is the SQLite database file (":memory:" works too).  If
+        ``max_size`` is None, the cache can grow forever.  An ``offline``
+        cache never lets the transport touch the network, so only cached
+        responses can be used.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.offline = offline
+
+        # transports are used from multiple threads, so share the connection
+        # and take turns using it
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_type TEXT,
+                    size INTEGER NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def get(self, url):
+        """Returns the ``CachedResponse`` for ``url``, or None if there isn't one"""
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT url, body, etag, last_modified, content_type "
+                "FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE url = ?",
+                (time.time(), url))
+        return CachedResponse(*row)
+
+    def put(self, url, body, etag=None, last_modified=None, content_type=None):
+        """Stores a response body, evicting old entries if we're too big"""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, body, etag, last_modified, content_type, len(body), time.time())
+            )
+            if self.max_size is not None:
+                self._evict()
+
+    def _evict(self):
+        size, = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if size <= self.max_size:
+            return
+
+        # walk from least to most recently used until enough is freed
+        evicted = []
+        for url, entry_size in self._db.execute(
+                "SELECT url, size FROM responses ORDER BY accessed"):
+            if size <= self.max_size:
+                break
+            evicted.append((url,))
+            size -= entry_size
+        self._db.executemany("DELETE FROM responses WHERE url = ?", evicted)
+
+    def size(self):
+        """The total size of all cached bodies, in bytes"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self):
+        """Removes everything from the cache"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM responses")
+
+    def close(self):
+        self._db.close()
+
+    def conditional_headers(self, cached):
+        """The headers to send to revalidate a ``CachedResponse``"""
+        headers = {}
+        if cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+        return headers
+
+    def store(self, url, resp):
+        """Stores a ``requests.Response`` for ``url`` if it's worth keeping"""
+        if resp.status_code == 200:
+            self.put(url, resp.content,
+                etag=resp.headers.get("ETag"),
+                last_modified=resp.headers.get("Last-Modified"),
+                content_type=resp.headers.get("Content-Type")
+            )
+
+    def to_response(self, cached):
+        """Makes a ``requests.Response`` out of a ``CachedResponse``"""
+        resp = requests.Response()
+        resp.url = cached.url
+        resp.status_code = 200
+        resp.reason = "OK"
+        resp._content = cached.body
+        resp.headers = CaseInsensitiveDict({
+            key: value for key, value in [
+                ("Content-Type", cached.content_type),
+                ("Content-Length", str(len(cached.body))),
+                ("ETag", cached.etag),
+                ("Last-Modified", cached.last_modified)
+            ] if value is not None
+        })
+        resp.from_cache = True
+        return resp
+
+
+
+class IdentifierCache:
+    """
+    A least-recently-used cache of user identifiers (usernames and emails)
+    to the profiles they belong to, which ``User.from_username`` and friends
+    use so they don't have to ask KA about the same user twice.
+
+    Profiles are stored along with when they were downloaded, so a ``User``
+    made from one knows how old its metadata is.
+    """
+    def __init__(self, max_size=10000, path=None):
+        """
+        At most ``max_size`` identifiers are kept in memory.  If ``path`` is
+        given, every profile is also saved to an SQLite database there, so
+        other processes (and later runs) can use them too.
+        """
+        self.max_size = max_size
+        self.path = path
+
+        self._entries = collections.OrderedDict() # key -> (profile, time)
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute("""
+                    CREATE TABLE IF NOT EXISTS identifiers (
+                        kind TEXT NOT NULL,
+                        identifier TEXT NOT NULL,
+                        profile TEXT NOT NULL,
+                        time REAL NOT NULL,
+                        PRIMARY KEY (kind, identifier)
+                    )
+                """)
+
+    @staticmethod
+    def _key(kind, identifier):
+        # KA doesn't care about the case of usernames or emails
+        return kind, identifier.lower()
+
+    def get(self, kind, identifier):
+        """
+        Returns ``(profile, time)`` for an identifier (``kind`` is "username"
+        or "email"), or None if it isn't cached.  ``time`` is when the
+        profile was downloaded, from ``time.time``.
+        """
+        key = self._key(kind, identifier)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    "SELECT profile, time FROM identifiers WHERE kind = ? AND identifier = ?",
+                    key
+                ).fetchone()
+                if row is not None:
+                    entry = json.loads(row[0]), row[1]
+                    self._remember(key, entry)
+
+        if entry is None:
+            return None
+        # don't let anyone mess up our copy
+        profile, downloaded = entry
+        return copy.deepcopy(profile), downloaded
+
+    def put(self, kind, identifier, profile):
+        """Caches the profile an identifier belongs to"""
+        key = self._key(kind, identifier)
+        entry = copy.deepcopy(profile), time.time()
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO identifiers VALUES (?, ?, ?, ?)",
+                        key + (json.dumps(entry[0]), entry[1]))
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def forget(self, kind, identifier):
+        """
+        Removes an identifier from the cache, for when someone changes their
+        username
+        """
+        key = self._key(kind, identifier)
+        with self._lock:
+            self._entries.pop(key, None)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        "DELETE FROM identifiers WHERE kind = ? AND identifier = ?", key)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        """Removes everything from the cache"""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM identifiers")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
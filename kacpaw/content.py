@@ -1,6 +1,15 @@
+import collections
+import itertools
+import time
+
 import requests
 import kacpaw.content_abcs as abcs
-from kacpaw.utils import kaurl, update_dict_path
+from kacpaw.cache import IdentifierCache
+from kacpaw.export import write_discussion
+from kacpaw.pagination import Paginator
+from kacpaw.projection import project
+from kacpaw.tracing import traced
+from kacpaw.utils import kaurl, run_concurrently, SingleFlight
 
 
 class User(abcs.Editable):
@@ -30,18 +39,54 @@ class User(abcs.Editable):
         "username": ["username"]
     }
 
+    # Where usernames and emails are looked up before asking KA.  Like
+    # transport, this can be replaced on User (say, with a persistent
+    # IdentifierCache), or set to None to always ask.
+    identifier_cache = IdentifierCache()
+    # so that threads looking up the same user at once only send one request
+    _lookups = SingleFlight()
+
     def __init__(self, ka_id):
         self.ka_id = ka_id
 
     @classmethod
+    def fetch_many(cls, ka_ids, workers=8, fields=None):
+        """
+        Gets the metadata of the users with the ka_ids ``ka_ids`` concurrently.
+        See ``kacpaw.content_abcs.fetch_many``.
+        """
+        return abcs.fetch_many(map(cls, ka_ids), workers, fields)
+
+    @classmethod
+    @traced
     def _from_identifier(cls, identifier_kind, identifier):
-        """Gets a user by an arbitrary identifier"""
-        resp = requests.get(cls.get_user, params={
+        """
+        Gets a user by an arbitrary identifier.  The profile we get back is
+        kept as the user's metadata, so it doesn't need to be requested again.
+        """
+        cache = cls.identifier_cache
+        cached = None if cache is None else cache.get(identifier_kind, identifier)
+        if cached is None:
+            cached = cls._lookups.do((cls.transport, identifier_kind, identifier.lower()),
+                cls._download_profile, identifier_kind, identifier)
+        profile, downloaded = cached
+
+        user = cls(profile["kaid"])
+        # the metadata is as old as the profile, not brand new
+        user._cache_metadata(profile, time.monotonic() - (time.time() - downloaded))
+        return user
+
+    @classmethod
+    def _download_profile(cls, identifier_kind, identifier):
+        resp = cls.transport.get(cls.get_user, params={
             identifier_kind: identifier
         })
         resp.raise_for_status()
 
-        return cls(resp.json()["kaid"])
+        profile = resp.json()
+        if cls.identifier_cache is not None:
+            cls.identifier_cache.put(identifier_kind, identifier, profile)
+        return profile, time.time()
 
     @classmethod
     def from_username(cls, username):
@@ -53,19 +98,40 @@ class User(abcs.Editable):
         """Gets a user by thier email"""
         return cls._from_identifier("email", email)
 
+    @classmethod
+    def from_usernames(cls, usernames, workers=8):
+        """
+        Gets lots of users by their usernames concurrently, returning a dict
+        of usernames to ``FetchResult``s (see ``kacpaw.content_abcs``) with
+        the users and their profiles as metadata.  If a lookup fails, its
+        result has the exception as its error instead, so one bad username
+        doesn't ruin the rest.  Usernames that KA doesn't know about get a
+        404 ``HTTPError``.  Each username is only looked up once, no matter
+        how many times it shows up.
+        """
+        def lookup(username):
+            try:
+                user = cls.from_username(username)
+            except Exception as error:
+                return username, abcs.FetchResult(None, None, error)
+            return username, abcs.FetchResult(user, user._metadata, None)
+
+        return dict(run_concurrently(lookup, set(usernames), workers))
+
     @property
     def id(self):
         """A user's id is their ka_id"""
         return self.ka_id
 
 
-# todo: things like Comments that have properties like text_content which send
-# off requests are for some reason being called when I use autocompletion in
-# my python repl.  This is bad because the properties take a long time to be
-# called and autocompletion results should be fast.  The properties can also
-# raise errors, which is extra bad.  This is due to hasattr which checks to
-# see if getattr raises an AttributeError, so I'm not sure if I can do much
-# about it...
+# Things like Comments that have properties like text_content which send off
+# requests were being called when I used autocompletion in my python repl.
+# This is bad because the properties take a long time to be called and
+# autocompletion results should be fast.  This is due to hasattr which checks
+# to see if getattr raises an AttributeError.  If that bothers you, set
+# ``unloaded = "raise"`` (on a class, or Content for everything), and the
+# properties raise NotLoadedError (an AttributeError) instead of sending
+# requests until you load() the content.
 class Comment(abcs.Editable, abcs.Replyable, abcs.Deletable):
     """Any kind of comment on KA"""
     # these properties work no matter where the comment is
@@ -78,26 +144,42 @@ class Comment(abcs.Editable, abcs.Replyable, abcs.Deletable):
 
     def __init__(self, comment_id, context):
         self.comment_id = comment_id
+        if isinstance(context, abcs.Content):
+            context._share_transport(self)
 
     def get_reply_data(self):
-        resp = requests.get(self.api_reply)
+        resp = self.transport.get(self.api_reply)
         resp.raise_for_status()
         yield from resp.json()
 
     def get_author(self):
         """Returns the ``User`` who wrote the comment."""
-        return User(self.get_metadata()["authorKaid"])
+        return self._share_transport(User(self.get_metadata()["authorKaid"]))
 
     def get_parent(self):
         raise NotImplementedError
 
+    @traced
     def edit(self, session, message):
+        """
+        Changes the comment's text to ``message``.  If we have fresh metadata
+        cached that says the text is already ``message``, nothing is sent.
+        Returns whether an edit request was sent.
+        """
+        # unlike Editable.edit, we don't need metadata to make the edit, so
+        # it's not worth a request just to compare
+        metadata = self._fresh_metadata()
+        if metadata is not None and self._has_value(metadata, "text_content", message):
+            return False
+
         session.put(self.api_edit,
             json={
                 "text": message
                 # topic?
             }
         ).raise_for_status()
+        self.invalidate()
+        return True
 
     @property
     def id(self):
@@ -121,6 +203,32 @@ class _CommentDoesntExistError(requests.HTTPError):
             "kacpaw._CommentDoesntExistError"
         ).format(comment))
 
+class CommentThread:
+    """
+    The replies to a ``ProgramComment``, along with an index of where each
+    reply is, so replies can be looked up by key without scanning the thread.
+    """
+    def __init__(self, replies):
+        self.replies = replies
+        self.positions = {reply["key"]: position for position, reply in enumerate(replies)}
+        self.time = time.monotonic()
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __getitem__(self, key):
+        """Gets the data for the reply with the key ``key``"""
+        return self.replies[self.positions[key]]
+
+    def after(self, key):
+        """Iterates over the data of the replies posted after ``key``"""
+        return itertools.islice(self.replies, self.positions[key] + 1, None)
+
+    def is_fresh(self, ttl):
+        """Same rules as ``Content.metadata_ttl``"""
+        return ttl is None or time.monotonic() - self.time < ttl
+
+
 class ProgramComment(Comment):
     """A comment in the context of a KA program"""
     api_get = property(kaurl("api/internal/discussions/scratchpad/{0.program_id}/comments?qa_expand_key={0.id}").format)
@@ -130,6 +238,16 @@ class ProgramComment(Comment):
     # can't just set reply_type to ProgramCommentReply
     reply_type = property(lambda _: ProgramCommentReply)
 
+    # When KA's response doesn't make it obvious that a comment exists,
+    # fetch_metadata sends another request to make sure.  If you know that
+    # your comments exist (say you got them from get_replies) and you're only
+    # reading, you can turn this off to save a request.  Be warned that
+    # without the check, comments that don't exist can give you the metadata
+    # of some other comment instead of raising an error.
+    check_exists = True
+
+    _thread = None
+
     def __init__(self, ka_id, context):
         """Program comments take a ka_id, which is a long string KA uses to identify the comment.  \
         Usually, this is a string that starts with "kaencrypted_".  I believe that some other types of \
@@ -160,16 +278,65 @@ class ProgramComment(Comment):
             return False
         return True
 
+    @traced
+    def get_thread(self, refresh=False):
+        """
+        Returns a ``CommentThread`` of the replies to this comment.
+
+        Like metadata, the thread is cached for ``metadata_ttl`` seconds
+        (unless ``refresh`` is true), so all the replies in a thread can share
+        a single request.
+        """
+        # a local, since a reply in another thread can invalidate us any time
+        thread = self._thread
+        if refresh or thread is None or not thread.is_fresh(self.metadata_ttl):
+            thread = CommentThread(list(Comment.get_reply_data(self)))
+            if self.metadata_ttl != 0:
+                self._thread = thread
+        return thread
+
+    def get_reply_data(self):
+        yield from self.get_thread().replies
+
+    def get_replies(self):
+        """
+        Yields the replies to this comment.  Like ``Program.get_replies``,
+        their data is already cached as their metadata.
+        """
+        for reply_data in self.get_reply_data():
+            reply = self.reply_type(reply_data["key"], self)
+            reply._cache_metadata(reply_data)
+            yield reply
+
+    def invalidate(self):
+        super().invalidate()
+        self._thread = None
+
+    def fetch_fields(self, names):
+        # our metadata is dug out of a bigger response, so the paths in
+        # meta_path_map don't work on the raw json
+        return project(self.fetch_metadata(), self._field_paths(names, self.meta_path_map))
+
     def get_program(self):
         """Returns the ``Program`` that the comment was posted on."""
-        return Program(self.program_id)
+        return self._share_transport(Program(self.program_id))
 
     get_parent = get_program
 
-    def get_metadata(self):
+    def fetch_metadata(self):
         # when using qa_expand_key, the first comment will be the one we want,
         # so pop out the first comment
-        data = super().get_metadata()["feedback"].pop(0)
+        feedback = super().fetch_metadata()["feedback"]
+        if not feedback: # there aren't any comments, so we can't be one
+            raise _CommentDoesntExistError(self)
+        data = feedback.pop(0)
+
+        # If KA found the comment, it will be the first one, so we know that
+        # it exists without asking again.  Otherwise, either the comment
+        # doesn't exist (and KA just gave us the normal first page) or we are
+        # a ProgramCommentReply and got the comment that started the thread.
+        if data["key"] == self.id or not self.check_exists:
+            return data
 
         # order _might_ matter here on the offchance that a comment is deleted
         # after we check that it exists an before we get its data
@@ -184,6 +351,23 @@ class ProgramComment(Comment):
 
 class ProgramCommentReply(ProgramComment):
     """A reply to a program comment"""
+    def __init__(self, ka_id, context):
+        """
+        Takes the same arguments as ``ProgramComment``.  If ``context`` is
+        the ``ProgramComment`` that started the thread (or a reply that knows
+        it), we remember it so that we don't have to ask KA for it.
+        """
+        super().__init__(ka_id, context)
+        self._parent = None
+        # whether _parent came from KA instead of being guessed from context
+        self._parent_confirmed = False
+
+        if isinstance(context, ProgramCommentReply):
+            self._parent = context._parent
+        elif isinstance(context, ProgramComment):
+            self._parent = context
+
+    @traced
     def reply(self, session, message):
         """Adds a ``ProgramCommentReply`` to the thread.
         The reply will start with the character '@', followed by the author of this comment \
@@ -195,16 +379,35 @@ class ProgramCommentReply(ProgramComment):
 
     def get_parent(self):
         """Returns the ``ProgramComment`` that started the thread."""
-        return ProgramComment(super().get_metadata()["key"], self)
-
-    def get_metadata(self):
+        if self._parent is None:
+            # get_metadata would give us our own metadata, so go through
+            # ProgramComment's fetch_metadata to get at the thread's first
+            # comment
+            self._parent = ProgramComment(ProgramComment.fetch_metadata(self)["key"], self)
+            self._parent_confirmed = True
+        return self._parent
+
+    def _get_thread(self):
+        """Returns the parent's ``CommentThread``, making sure we're in it"""
+        thread = self.get_parent().get_thread()
+        if self.id not in thread:
+            # we might have been posted after the thread was cached
+            thread = self.get_parent().get_thread(refresh=True)
+
+        if self.id not in thread and not self._parent_confirmed:
+            # or the context we were given wasn't really our parent
+            self._parent = None
+            thread = self.get_parent().get_thread()
+
+        if self.id not in thread:
+            raise _CommentDoesntExistError(self)
+        return thread
+
+    def fetch_metadata(self):
         """Returns a dictionary with information about this ``ProgramCommentReply``."""
-        # there's no way that I've found to get comment reply metadata directly, 
-        # so we iterate though the comment thread until you find this comment
-        for comment_data in self.get_parent().get_reply_data():
-            if comment_data["key"] == self.id:
-                return comment_data
-        raise _CommentDoesntExistError(self)
+        # there's no way that I've found to get comment reply metadata
+        # directly, so we look this comment up in the parent's thread
+        return self._get_thread()[self.id]
 
         # I'm keeping this todo until I can fully address it, although I did
         # add an error
@@ -225,12 +428,101 @@ class ProgramCommentReply(ProgramComment):
     def get_reply_data(self):
         """Yields all ``ProgramCommentReply``s that were posted after this one."""
         # Similar principle to get_metadata - we can't get what we want directly.
-        gen = self.get_parent().get_reply_data()
+        yield from self._get_thread().after(self.id)
 
-        while next(gen)["key"] != self.id:
-            pass
+    def invalidate(self):
+        super().invalidate()
+        # our metadata comes from the parent's thread, so that needs to go too
+        if self._parent is not None:
+            self._parent.invalidate()
 
-        yield from gen
+
+Watermark = collections.namedtuple("Watermark", [
+    "date", # the date of the newest comment we've seen
+    "threads" # {key: replyCount} for the newest comments, whose replies we watch
+])
+Watermark.__doc__ = """
+Where ``Program.iter_new_replies`` left off.  It's made of json-friendly
+types, so to save one, save ``watermark._asdict()`` as json, and load it with
+``Watermark(**data)``.
+"""
+
+
+class NewReplies:
+    """
+    An iterator over what's new in a program's discussion since a
+    ``Watermark``.  See ``Program.iter_new_replies``.
+    """
+    def __init__(self, program, since=None, page_size=None, watch_threads=None):
+        self.program = program
+        self.since = since
+        self.page_size = page_size or program.reply_params["limit"]
+        self.watch_threads = self.page_size if watch_threads is None else watch_threads
+
+        # until we're done, the best we can say is that nothing has changed
+        self.watermark = since
+        self.paginator = None
+
+        self._items = self._iter_new()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    def _comment(self, data):
+        comment = ProgramComment(data["key"], self.program)
+        comment._cache_metadata(data)
+        return comment
+
+    def _iter_new(self):
+        since = self.since
+        seen = {} if since is None else since.threads
+        unpassed = set(seen) # seen comments we haven't gotten to yet
+        threads = collections.OrderedDict() # the next watermark's threads
+        newest_date = None if since is None else since.date
+
+        # newest comments first, so we can stop as soon as we get to old ones
+        self.paginator = self.program.paginate_replies(page_size=self.page_size, sort=2)
+        for data in self.paginator:
+            key = data["key"]
+            if newest_date is None or data["date"] > newest_date:
+                newest_date = data["date"]
+            if len(threads) < self.watch_threads:
+                threads[key] = data["replyCount"]
+            unpassed.discard(key)
+
+            # Older than everything we've seen, but not something we've seen.
+            # Comments can share a date, so the keys get the last word.  If
+            # there weren't any comments to see, the date is all we have.
+            if since is None:
+                older = True
+            elif key in seen or since.date is None:
+                older = False
+            elif seen:
+                older = data["date"] < since.date
+            else:
+                older = data["date"] <= since.date
+
+            if since is not None and key not in seen and not older:
+                # a new comment, along with any replies it already has
+                comment = self._comment(data)
+                yield comment
+                if data["replyCount"]:
+                    yield from comment.get_replies()
+            elif data["replyCount"] > seen.get(key, data["replyCount"]):
+                # KA gives replies oldest first, so the new ones are at the end
+                comment = self._comment(data)
+                yield from itertools.islice(comment.get_replies(), seen[key], None)
+
+            # With nothing seen to pass, only an old comment means we've caught
+            # up, and without a date we have to go all the way to the end
+            if len(threads) >= self.watch_threads and (older or seen and not unpassed):
+                break
+
+        self.paginator.close()
+        self.watermark = Watermark(newest_date, dict(threads))
 
 
 # jinja2 is probably a good choice for Program formaters.  I might even want to add one to this class for convenience.
@@ -244,16 +536,30 @@ class Program(abcs.Editable, abcs.Replyable, abcs.Questionable, abcs.Spinoffable
     api_create_program = kaurl("api/internal/scratchpads")
     reply_type = ProgramComment
 
+    # see _fix_metadata
+    raw_path_map = {
+        "image_url": ["imageUrl"]
+    }
+
     meta_path_map = {
         "image_url": ["revision", "imageUrl"],
         "url": ["url"],
         "code": ["revision", "code"],
+        "revision_id": ["revision", "id"],
         "width": ["width"],
         "height": ["height"],
         "title": ["title"],
         "kind": ["userAuthoredContentType"]
     }
 
+    # query parameters sent with each request for a page of comments
+    reply_params = {
+        "sort": 1,
+        "subject": "all",
+        "lang": "en",
+        "limit": 10
+    }
+
     def __init__(self, program_id):
         """Programs are constructed using a program id.
         A program id is the last part of a program's url, so \
@@ -261,30 +567,99 @@ class Program(abcs.Editable, abcs.Replyable, abcs.Questionable, abcs.Spinoffable
         has the program id 4617827881975808"""
         self.program_id = program_id
 
+    @classmethod
+    def fetch_many(cls, program_ids, workers=8, fields=None):
+        """
+        Gets the metadata of the programs with the ids ``program_ids``
+        concurrently.  See ``kacpaw.content_abcs.fetch_many``.
+        """
+        return abcs.fetch_many(map(cls, program_ids), workers, fields)
+
     @classmethod
     def create(cls):
         raise todo
 
-    def get_reply_data(self, **params):
-        resp = requests.get(self.api_reply,
-            params=dict({
-                "sort": 1,
-                "subject": "all",
-                "lang": "en",
-                "limit": 10
-            }, **params)
+    def paginate_replies(self, page_size=None, cursor=None, max_items=None,
+                         prefetch=False, **params):
+        """
+        Returns a ``Paginator`` over data about the comments on this program.
+
+        ``page_size`` is how many comments are requested at once (the default
+        is in ``reply_params``).  Keep the paginator around if you want to
+        check its ``cursor`` so you can resume later.  See ``Paginator`` for
+        the other arguments, and ``params`` are extra query parameters.
+        """
+        params = dict(self.reply_params, **params)
+        if page_size is not None:
+            params["limit"] = page_size
+
+        return Paginator(self.transport, self.api_reply, params,
+            cursor=cursor, max_items=max_items, prefetch=prefetch,
+            operation="Program.get_reply_data"
         )
-        resp.raise_for_status()
-        data = resp.json()
 
-        yield from data["feedback"]
-        if not data["isComplete"]: # There are more comments we haven't gotten to yet
-            yield from self.get_reply_data(**dict(params, cursor=data["cursor"]))
+    def get_reply_data(self, **kwargs):
+        """Yields data about the comments on this program.  ``kwargs`` are
+        passed to ``paginate_replies``."""
+        yield from self.paginate_replies(**kwargs)
+
+    def get_replies(self, **kwargs):
+        """
+        Yields the comments on this program.  Their data is already cached as
+        their metadata, so reading them doesn't send more requests.
+        ``kwargs`` are passed to ``paginate_replies``.
+        """
+        for comment_data in self.get_reply_data(**kwargs):
+            comment = self.reply_type(comment_data["key"], self)
+            comment._cache_metadata(comment_data)
+            yield comment
+
+    def export_discussion(self, fp, workers=4, page_size=None, cursor=None, skip=()):
+        """
+        Writes every comment on this program and every reply to them to the
+        text file ``fp`` as json lines, downloading up to ``workers`` threads
+        of replies at once.  Everything is written as soon as it's
+        downloaded, so it doesn't matter how big the discussion is.
+
+        Checkpoints with cursors are written along the way, so you can resume
+        an interrupted export by passing the last one's ``cursor``, and its
+        "done" keys as ``skip``.  See
+        ``kacpaw.export`` for the format, and ``kacpaw.export.export_to_file``
+        to have resuming taken care of.  Returns how many comments and
+        replies were written.
+        """
+        def get_replies(comment_data):
+            return list(ProgramComment(comment_data["key"], self).get_reply_data())
+
+        paginator = self.paginate_replies(page_size=page_size, cursor=cursor, prefetch=True)
+        return write_discussion(fp, self.id, paginator, get_replies, workers, skip)
+
+    def iter_new_replies(self, since=None, page_size=None, watch_threads=None):
+        """
+        Returns an iterator over the comments (``ProgramComment``s) and
+        replies (``ProgramCommentReply``s) posted since the ``Watermark``
+        ``since``.  Once it's exhausted, its ``watermark`` attribute is the
+        watermark to pass next time.  Without ``since``, nothing is yielded
+        and you just get a watermark for where the discussion is now.
+
+        Comments are paged through newest first, stopping as soon as we get
+        to ones we've seen, so if nothing has changed, this only costs a
+        single request for a page of ``page_size`` comments.  New replies are
+        found by watching the reply counts of the newest ``watch_threads``
+        comments (by default, a page's worth), and only threads whose count
+        went up are downloaded.  Replies to older comments aren't noticed.
+
+        The content that's yielded already has its metadata cached, so
+        reading it doesn't send more requests.
+        """
+        return NewReplies(self, since, page_size, watch_threads)
+
+    def fetch_metadata(self):
+        return self._fix_metadata(super().fetch_metadata())
 
-    def get_metadata(self):
-        metadata = super().get_metadata()
+    def _fix_metadata(self, metadata):
         # image_url isn't in the right place, so put it there
-        return update_dict_path(metadata, self.meta_path_map["image_url"], metadata.get("imageUrl"))
+        return self._meta_setters["image_url"](metadata, metadata.get("imageUrl"))
 
     @property
     def id(self):
@@ -1,5 +1,14 @@
-import requests
-from .utils import raiser, method, get_dict_path, update_dict_path
+import collections
+import copy
+import functools
+import time
+
+from .projection import project, project_response
+from .tracing import traced
+from .transport import default_transport
+from .utils import (
+    raiser, method, dict_path_getter, dict_paths_getter, dict_path_setter, run_concurrently
+)
 
 
 # A property for use in abstract base classes that must be overridden or it
@@ -13,7 +22,10 @@ def _make_item_getter(cls, item_name):
     """
     @method(cls, item_name)
     def get_meta_item(self):
-        return get_dict_path(self.get_metadata(), self.meta_path_map[item_name])
+        metadata = self._fresh_metadata()
+        if metadata is not None:
+            return self._meta_getters[item_name](metadata)
+        return self._get_unloaded_item(item_name)
     
     # todo: beter auto-generated docstring for this
     get_meta_item.__doc__ = "Gets ``{item_name}`` from ``{cls.__name__}``".format(
@@ -23,6 +35,19 @@ def _make_item_getter(cls, item_name):
     return property(get_meta_item)
 
 
+class NotLoadedError(AttributeError):
+    """
+    Raised when reading a ``meta_path_map`` item from content that hasn't
+    been loaded, if its ``unloaded`` policy says not to fetch it.  It's an
+    ``AttributeError`` so that ``hasattr`` and friends just say no.
+    """
+    def __init__(self, content, item_name):
+        super().__init__("{} isn't loaded, so it has no {} yet.  Call load() or prefetch() "
+            "first.".format(type(content).__name__, item_name))
+        self.content = content
+        self.item_name = item_name
+
+
 # We use a metaclass instead of a simple class decorator because we want it to
 # work with inheritance
 class MetaPathMapClass(type):
@@ -37,10 +62,18 @@ class MetaPathMapClass(type):
     something like ``{"revision": {"code": "..."}}``, so it's meta_path_map
     might include ``{"code": ["revision", "code"]}``.  See comments about dict
     paths in utils.py for more info.
+
+    Each path is compiled into a getter and a setter when the class is
+    created, so reading an item doesn't have to interpret its path every
+    time.  That means changing ``meta_path_map`` after the class is made
+    doesn't do anything.
     """
     def __init__(cls, *args, **kwargs):
         super().__init__(*args, **kwargs)
         meta_path_map = cls.meta_path_map
+        cls._meta_getters = {name: dict_path_getter(path) for name, path in meta_path_map.items()}
+        cls._meta_setters = {name: dict_path_setter(path) for name, path in meta_path_map.items()}
+        cls._meta_item_getters = {} # for meta_getter
         for item_name in meta_path_map:
             if not hasattr(cls, item_name):
                 setattr(cls, item_name, _make_item_getter(cls, item_name))
@@ -51,6 +84,35 @@ class Content(metaclass=MetaPathMapClass):
     id = api_get = abc_prop
     meta_path_map = {}
 
+    # How many seconds metadata is reused for before get_metadata sends
+    # another request.  None means cached metadata never expires and 0 turns
+    # caching off.  This can be overridden by subclasses or on single objects.
+    metadata_ttl = 30
+
+    # cached metadata and the time.monotonic() it was fetched at.  These are
+    # only set on instances once something has been cached
+    _metadata = _metadata_time = None
+    # same deal, but for the items that prefetch got
+    _fields = _fields_time = None
+
+    # What reading a meta_path_map property does when the content isn't
+    # loaded (there's no fresh metadata):
+    #  * "fetch" sends a request to get it
+    #  * "raise" raises NotLoadedError, so nothing is sent by accident
+    #  * "stale" uses old metadata if there is any, or raises NotLoadedError
+    # Like metadata_ttl, this can be set on a class or on a single object.
+    unloaded = "fetch"
+
+    # What unauthenticated reads are sent through.  This can be a
+    # kacpaw.Transport, or anything else with a requests-style get method,
+    # like a KASession.  Content created from other content (replies,
+    # parents, authors...) uses the same transport as the content it came from
+    transport = default_transport
+
+    # Where meta_path_map items are in the response from api_get, for the
+    # ones that fetch_metadata moves around.  Used by fetch_fields.
+    raw_path_map = {}
+
     def __init__(self): # Content is too abstract to be initialized
         raise NotImplementedError
 
@@ -62,14 +124,270 @@ class Content(metaclass=MetaPathMapClass):
         return hash(self.id)
 
     # Content should have data about it
+    @traced
     def get_metadata(self):
-        """Gets the content's metadata as a dict"""
-        resp = requests.get(self.api_get)
+        """
+        Gets the content's metadata as a dict
+
+        Metadata is cached for ``metadata_ttl`` seconds, so reading a bunch of
+        ``meta_path_map`` properties only costs one request.  The returned
+        dict may be the cached one, so don't modify it.
+        """
+        metadata = self._fresh_metadata()
+        if metadata is not None:
+            return metadata
+
+        metadata = self.fetch_metadata()
+        self._cache_metadata(metadata)
+        return metadata
+
+    def _cache_metadata(self, metadata, fetched=None):
+        """
+        Caches metadata that we got somehow, as of the time.monotonic()
+        ``fetched`` (by default, now)
+        """
+        if self.metadata_ttl != 0:
+            self._metadata = metadata
+            self._metadata_time = time.monotonic() if fetched is None else fetched
+
+    def fetch_metadata(self):
+        """
+        Requests the content's metadata from KA, ignoring the cache.
+
+        Subclasses that need to massage the metadata should override this
+        rather than ``get_metadata`` so that the result gets cached.
+        """
+        resp = self.transport.get(self.api_get)
         resp.raise_for_status()
 
         # KA uses json to represent API structures
         return resp.json()
 
+    @traced
+    def get_fields(self, *names):
+        """
+        Gets the ``meta_path_map`` items ``names`` as a dict, like
+        ``program.get_fields("title", "kind")``.
+
+        If fresh metadata is cached, it's used.  Otherwise only the requested
+        items are kept from the response (see ``fetch_fields``), which is much
+        lighter than ``get_metadata`` when the metadata is big.  Since the
+        result isn't the full metadata, it isn't cached.
+        """
+        metadata = self._fresh_metadata()
+        if metadata is not None:
+            return project(metadata, self._field_paths(names, self.meta_path_map))
+        return self.fetch_fields(names)
+
+    def fetch_fields(self, names):
+        """
+        Requests the ``meta_path_map`` items ``names`` from KA, ignoring the
+        cache, and returns them as a dict.  Items missing from the response
+        are None.
+
+        The response is streamed (see ``kacpaw.projection``), unless the
+        transport has a ``ResponseCache``, which needs the whole response.
+        """
+        resp = self.transport.get(self.api_get, stream=True)
+        resp.raise_for_status()
+        return project_response(resp,
+            self._field_paths(names, dict(self.meta_path_map, **self.raw_path_map))
+        )
+
+    @classmethod
+    def meta_getter(cls, *names):
+        """
+        Returns a function that gets the ``meta_path_map`` items ``names`` out
+        of metadata as a tuple, all in one go, like ``operator.itemgetter``::
+
+            get_title_and_code = Program.meta_getter("title", "code")
+            for metadata in lots_of_program_metadata:
+                title, code = get_title_and_code(metadata)
+
+        Missing items raise ``KeyError``, unlike ``get_fields``.
+        """
+        getter = cls._meta_item_getters.get(names)
+        if getter is None:
+            getter = cls._meta_item_getters[names] = dict_paths_getter(
+                cls.meta_path_map[name] for name in names)
+        return getter
+
+    def _field_paths(self, names, path_map):
+        for name in names:
+            if name not in self.meta_path_map:
+                raise KeyError(name)
+        return {name: path_map[name] for name in names}
+
+    def _share_transport(self, content):
+        """Makes ``content`` use our transport, returning ``content``"""
+        if self.transport is not type(content).transport:
+            content.transport = self.transport
+        return content
+
+    def _is_fresh(self, fetched):
+        if fetched is None:
+            return False
+        return self.metadata_ttl is None or time.monotonic() - fetched < self.metadata_ttl
+
+    def _fresh_metadata(self):
+        """
+        Returns the cached metadata if it's fresh, or None.  Use this instead
+        of checking ``_metadata_is_fresh`` and then reading ``_metadata``,
+        since another thread could call ``invalidate`` in between.
+        """
+        metadata, fetched = self._metadata, self._metadata_time
+        if metadata is not None and self._is_fresh(fetched):
+            return metadata
+        return None
+
+    def _metadata_is_fresh(self):
+        return self._fresh_metadata() is not None
+
+    def _get_unloaded_item(self, item_name):
+        # what a property gives when there's no fresh metadata
+        found, value = self._cached_unloaded_item(item_name)
+        if found:
+            return value
+        return self._meta_getters[item_name](self.get_metadata())
+
+    def _cached_unloaded_item(self, item_name):
+        """
+        What the ``unloaded`` policy says a property gives without fresh
+        metadata, short of sending a request.  Returns ``(True, value)``, or
+        ``(False, None)`` if the metadata should be fetched.  Async content
+        shares this, since only the fetching is different.
+        """
+        fields, fetched = self._fields, self._fields_time
+        prefetched = fields is not None and item_name in fields
+        if prefetched and self._is_fresh(fetched):
+            return True, fields[item_name]
+
+        if self.unloaded == "fetch":
+            return False, None
+        if self.unloaded == "stale":
+            metadata = self._metadata
+            if metadata is not None:
+                return True, self._meta_getters[item_name](metadata)
+            if prefetched:
+                return True, fields[item_name]
+        elif self.unloaded != "raise":
+            raise ValueError("unloaded should be 'fetch', 'raise' or 'stale', not {!r}".format(
+                self.unloaded))
+        raise NotLoadedError(self, item_name)
+
+    @property
+    def loaded(self):
+        """Whether there's fresh metadata, so reading properties won't send requests"""
+        return self._metadata_is_fresh()
+
+    def load(self):
+        """
+        Gets the metadata unless fresh metadata is already cached, so that
+        reading properties doesn't send requests.  Returns self, so you can
+        write ``program = Program(program_id).load()``.
+        """
+        self.get_metadata()
+        return self
+
+    def prefetch(self, *names):
+        """
+        Like ``load``, but only for the ``meta_path_map`` items ``names``,
+        which is lighter for content with big metadata (see ``get_fields``).
+        Returns self.
+        """
+        if not self._metadata_is_fresh():
+            self._cache_fields(self.get_fields(*names))
+        return self
+
+    def _cache_fields(self, fields):
+        if self.metadata_ttl != 0:
+            self._fields = fields
+            self._fields_time = time.monotonic()
+
+    def invalidate(self):
+        """Throws away cached metadata so the next access sends a request"""
+        self._metadata = self._metadata_time = None
+        self._fields = self._fields_time = None
+
+    def refresh(self):
+        """Throws away cached metadata and gets it again"""
+        self.invalidate()
+        return self.get_metadata()
+
+
+class FetchResult(collections.namedtuple("FetchResult", ["content", "metadata", "error"])):
+    """
+    The result of getting one piece of content's metadata in ``fetch_many``.
+    If something went wrong, ``metadata`` is None and ``error`` is the
+    exception that was raised.  When ``fetch_many`` was given ``fields``,
+    ``metadata`` is the dict from ``get_fields`` instead.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _fetch_result(content, fields):
+    try:
+        if fields is not None:
+            return FetchResult(content, content.get_fields(*fields), None)
+        return FetchResult(content, content.get_metadata(), None)
+    except Exception as error: # one bad id shouldn't ruin the whole batch
+        return FetchResult(content, None, error)
+
+
+def fetch_many(contents, workers=8, fields=None):
+    """
+    Gets the metadata of every content object in ``contents`` using a pool of
+    ``workers`` threads, yielding a ``FetchResult`` for each one as soon as
+    it's done (so not necessarily in order).
+
+    The metadata ends up in each object's cache, just like calling
+    ``get_metadata``.  If you only need a few ``meta_path_map`` items, pass
+    their names as ``fields`` to use ``get_fields`` instead, which saves a lot
+    of memory for big batches (but doesn't fill the cache).
+
+    Requests go through each object's transport, so to really get
+    ``workers`` requests going at once, the transport's ``pool_size`` should
+    be at least ``workers``.
+    """
+    return run_concurrently(functools.partial(_fetch_result, fields=fields), contents, workers)
+
+
+class EditResult(collections.namedtuple("EditResult", ["content", "changed", "error"])):
+    """
+    The result of one edit in ``edit_many``.  ``changed`` is what ``edit``
+    returned, and ``error`` is the exception that was raised, if any.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _edit_result(edit, session):
+    content, kwargs = edit
+    try:
+        return EditResult(content, content.edit(session, **kwargs), None)
+    except Exception as error:
+        return EditResult(content, None, error)
+
+
+def edit_many(session, edits, workers=8):
+    """
+    Makes a bunch of edits using a pool of ``workers`` threads.  ``edits`` is
+    an iterable of ``(content, kwargs)`` pairs, where ``kwargs`` is what you
+    would pass to ``content.edit``.  Yields an ``EditResult`` for each edit as
+    it finishes.
+
+    Edits that wouldn't change anything are skipped by ``edit``, so if the
+    metadata is already cached (say from ``fetch_many``), they cost nothing.
+    """
+    return run_concurrently(functools.partial(_edit_result, session=session), edits, workers)
+
 
 # todo: Votable?  Also some of these -able names sound kinda awkward.
 
@@ -80,6 +398,7 @@ class Editable(Content):
     # implementer decide
     api_edit_method = "PUT"
 
+    @traced
     def edit(self, session, **kwargs):
         """
         Modifies the content's metadata using ``meta_path_map`` keys passed in
@@ -87,22 +406,39 @@ class Editable(Content):
 
         This assumes that the data passed into the content's ``edit`` request
         is formatted similarily to the content's metadata.
+
+        Cached metadata is used if it's fresh, and if every item already has
+        the value it's being set to, nothing is sent at all.  Returns whether
+        an edit request was sent.
         """
         metadata = self.get_metadata()
+        if all(self._has_value(metadata, name, value) for name, value in kwargs.items()):
+            return False
 
+        # copy so that a failed edit doesn't leave junk in the cache
+        metadata = copy.deepcopy(metadata)
         for name, value in kwargs.items():
-            update_dict_path(metadata, self.meta_path_map[name], value)
+            self._meta_setters[name](metadata, value)
 
         session.request(
             self.api_edit_method, self.api_edit,
             json=metadata
         ).raise_for_status()
+        self.invalidate()
+        return True
+
+    def _has_value(self, metadata, name, value):
+        try:
+            return self._meta_getters[name](metadata) == value
+        except (KeyError, TypeError): # the path doesn't exist yet
+            return False
 
 
 class Replyable(Content):
     """An interface for content on KA that can be replied to"""
     api_reply = reply_type = abc_prop
 
+    @traced
     def reply(self, session, message, topic="computer-programming"):
         """Forms a reply to this content, returning the reply content object"""
         resp = session.post(self.api_reply,
@@ -112,6 +448,8 @@ class Replyable(Content):
             }
         )
         resp.raise_for_status()
+        # things like reply counts are part of our metadata
+        self.invalidate()
         return self.reply_type(resp.json()["key"], self)
 
     def get_reply_data(self):
@@ -154,6 +492,8 @@ class Deletable(Content):
     """An interface for content on KA that can be deleted"""
     api_delete = abc_prop
 
+    @traced
     def delete(self, session):
         """Deletes this content"""
-        session.delete(self.api_delete).raise_for_status()
\ No newline at end of file
+        session.delete(self.api_delete).raise_for_status()
+        self.invalidate()
\ No newline at end of file
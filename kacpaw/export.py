@@ -0,0 +1,139 @@
+"""
+Exporting a program's whole discussion as JSON lines
+
+Every line of an export is a json object with a "type":
+
+* ``{"type": "comment", "key": ..., "parent": <program id>, "data": {...}}``
+* ``{"type": "reply", "key": ..., "parent": <comment key>, "data": {...}}``
+* ``{"type": "checkpoint", "cursor": ..., "done": [...], "complete": false}``
+
+Each comment is written along with its replies as soon as they've been
+downloaded.  Checkpoints are written whenever every comment on a page of the
+program's comments is done, so an interrupted export can pick up where it
+left off by truncating the file after its last checkpoint and starting again
+from the checkpoint's cursor.  Since threads are downloaded concurrently, a
+few comments from later pages might be written before the checkpoint.  Their
+keys are in "done", so they can be skipped.  ``Program.export_discussion``
+and ``python -m kacpaw export`` do all this.
+"""
+
+import collections
+import json
+
+from .utils import run_concurrently
+
+
+def _write_line(fp, obj):
+    fp.write(json.dumps(obj, separators=(",", ":")) + "\n")
+
+
+def write_discussion(fp, parent_id, paginator, get_replies, workers=4, skip=()):
+    """
+    Writes the comments from ``paginator`` (a ``kacpaw.pagination.Paginator``)
+    and their replies (from ``get_replies(comment_data)``) to the text file
+    ``fp``.  Up to ``workers`` threads of replies are downloaded at once.
+    Comments with keys in ``skip`` are left out.  Returns how many comments
+    and replies were written.
+    """
+    # Page cursor -> how many of its comments aren't written yet, oldest
+    # page first.  Only the thread running this function touches it, since
+    # run_concurrently pulls items and yields results in our thread.
+    pending = collections.OrderedDict()
+    # page cursor -> keys of the comments on it that have been written
+    done = collections.defaultdict(list)
+    skip = set(skip)
+    written = 0
+
+    def comments():
+        for comment_data in paginator:
+            # paginator.cursor is the cursor of the page this came from
+            page = paginator.cursor
+            if comment_data["key"] in skip:
+                # it was written before we resumed, so it's still done, and
+                # has to stay in the checkpoints in case we resume again
+                pending.setdefault(page, 0)
+                done[page].append(comment_data["key"])
+                continue
+            pending[page] = pending.get(page, 0) + 1
+            yield page, comment_data
+
+    def download(item):
+        page, comment_data = item
+        replies = get_replies(comment_data) if comment_data.get("replyCount") else []
+        return page, comment_data, replies
+
+    for page, comment_data, replies in run_concurrently(download, comments(), workers):
+        _write_line(fp, {"type": "comment", "key": comment_data["key"],
+            "parent": parent_id, "data": comment_data})
+        for reply_data in replies:
+            _write_line(fp, {"type": "reply", "key": reply_data["key"],
+                "parent": comment_data["key"], "data": reply_data})
+        written += 1 + len(replies)
+        pending[page] -= 1
+        done[page].append(comment_data["key"])
+
+        # A page is done once all of its comments are written and the
+        # paginator has moved on to the next one.  Then it's safe to resume
+        # from the next page.
+        checkpoint = None
+        while len(pending) > 1:
+            first_page = next(iter(pending))
+            if pending[first_page]:
+                break
+            del pending[first_page]
+            done.pop(first_page, None)
+            checkpoint = next(iter(pending))
+        if checkpoint is not None:
+            _write_line(fp, {"type": "checkpoint", "cursor": checkpoint,
+                "done": [key for page in pending for key in done.get(page, ())],
+                "complete": False})
+            fp.flush()
+
+    if paginator.complete:
+        _write_line(fp, {"type": "checkpoint", "cursor": None, "complete": True})
+    fp.flush()
+    return written
+
+
+def last_checkpoint(path):
+    """
+    Finds the last checkpoint in the export at ``path``.  Returns the
+    checkpoint (or None if there isn't one) and the position in the file just
+    after it, where any unfinished work starts.
+    """
+    checkpoint, end = None, 0
+    position = 0
+    with open(path, "rb") as file:
+        for line in file:
+            position += len(line)
+            if not line.endswith(b"\n"):
+                break # the export was cut off in the middle of a line
+            if b'"checkpoint"' in line: # don't bother parsing everything
+                item = json.loads(line.decode("utf-8"))
+                if item["type"] == "checkpoint":
+                    checkpoint, end = item, position
+    return checkpoint, end
+
+
+def export_to_file(program, path, resume=True, **kwargs):
+    """
+    Exports the discussion on ``program`` to the file at ``path``.  If
+    ``resume`` is true and there's an unfinished export there already, it's
+    continued from its last checkpoint.  ``kwargs`` go to
+    ``Program.export_discussion``.  Returns how many comments and replies
+    were written, which is 0 if the export was already complete.
+    """
+    cursor, skip = None, ()
+    try:
+        checkpoint, end = last_checkpoint(path) if resume else (None, 0)
+    except FileNotFoundError:
+        checkpoint, end = None, 0
+
+    if checkpoint is not None:
+        if checkpoint["complete"]:
+            return 0
+        cursor, skip = checkpoint["cursor"], checkpoint["done"]
+
+    with open(path, "a+", encoding="utf-8") as fp:
+        fp.truncate(end) # throw away anything after the checkpoint
+        return program.export_discussion(fp, cursor=cursor, skip=skip, **kwargs)
@@ -0,0 +1,255 @@
+"""
+Small stand-ins for content, for when you need to keep track of lots of it
+
+Content objects carry around caches, transports and so on, which adds up to
+a couple hundred bytes each.  Handles only remember what identifies the
+content (using ``__slots__``), and turn into the real thing with
+``content()``.  They compare and hash just like content does, so a handle
+and the content it stands for are interchangeable in sets and dicts.
+
+For really big collections of comments, ``ProgramCommentSet`` packs comment
+keys into arrays, using a bit over half as many bytes as the keys are long.
+"""
+
+import re
+import sys
+from array import array
+
+from .content import User, Program, ProgramComment, ProgramCommentReply
+
+
+def _intern(value):
+    # lots of handles share a few program ids, so keep one copy of each
+    return sys.intern(value) if type(value) is str else value
+
+
+class Handle:
+    """Base class for handles.  Subclasses set ``content_type``."""
+    __slots__ = ("id",)
+    content_type = None
+
+    def __init__(self, id):
+        self.id = id
+
+    # same as Content, so handles and content can be mixed
+    def __eq__(self, other):
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.id)
+
+    def content(self):
+        """Makes the content this handle stands for"""
+        return self.content_type(self.id)
+
+
+class UserHandle(Handle):
+    __slots__ = ()
+    content_type = User
+
+
+class ProgramHandle(Handle):
+    __slots__ = ()
+    content_type = Program
+
+    def __init__(self, program_id):
+        self.id = _intern(program_id)
+
+
+class ProgramCommentHandle(Handle):
+    """A handle for a ``ProgramComment`` or (if ``is_reply``) a ``ProgramCommentReply``"""
+    __slots__ = ("program_id", "is_reply")
+
+    def __init__(self, key, program_id, is_reply=False):
+        self.id = key
+        self.program_id = _intern(program_id)
+        self.is_reply = is_reply
+
+    def __repr__(self):
+        return "{}({!r}, {!r}, is_reply={!r})".format(
+            type(self).__name__, self.id, self.program_id, self.is_reply)
+
+    def content(self):
+        content_type = ProgramCommentReply if self.is_reply else ProgramComment
+        return content_type(self.id, Program(self.program_id))
+
+
+def handle(content):
+    """Makes a handle for some content"""
+    if isinstance(content, Handle):
+        return content
+    if isinstance(content, ProgramComment):
+        return ProgramCommentHandle(content.id, content.program_id,
+            isinstance(content, ProgramCommentReply))
+    if isinstance(content, Program):
+        return ProgramHandle(content.id)
+    if isinstance(content, User):
+        return UserHandle(content.id)
+    raise TypeError("there are no handles for {}".format(type(content).__name__))
+
+
+class ProgramCommentSet:
+    """
+    A compact set of program comments and replies, for deduplicating huge
+    numbers of them.
+
+    The keys are stored one after another in a single byte array (without
+    the "kaencrypted_" that most of them start with), along with arrays of
+    where each one starts and which program it's on.  Real keys are a few
+    hundred characters of hex split up by underscores, so those are stored
+    as the bytes the hex stands for, which takes half the space.  Membership
+    is checked with an open addressing hash table of array indexes.
+    Comments only become objects when you iterate over the set.
+
+    Things can be added, but not removed.
+    """
+    _prefix = "kaencrypted_"
+
+    # flags packed into the low bits of _info, above which is the index of
+    # the program id
+    _REPLY = 1
+    _PREFIXED = 2
+    _PACKED = 4 # the hex was packed into bytes
+    _FLAG_BITS = 3
+    _ENCODING_FLAGS = _PREFIXED | _PACKED
+
+    _hex_part = re.compile(r"(?:[0-9a-f]{2})*")
+
+    def __init__(self, comments=()):
+        """``comments`` can be comments, replies or their handles"""
+        self._program_ids = []
+        self._program_indexes = {}
+        self._keys = bytearray()
+        self._offsets = array("Q", [0]) # key i is _keys[_offsets[i]:_offsets[i + 1]]
+        self._info = array("I") # program index and flags for each key
+        self._table = array("i", [-1]) * 16 # indexes of keys, or -1 for empty slots
+
+        for comment in comments:
+            self.add(comment)
+
+    def _encode(self, key):
+        """Returns the bytes we store for ``key``, and the flags to decode them"""
+        flags = 0
+        if key.startswith(self._prefix):
+            key = key[len(self._prefix):]
+            flags |= self._PREFIXED
+
+        parts = key.split("_")
+        if all(self._hex_part.fullmatch(part) for part in parts):
+            # each part is its length (as 2 bytes) and then its bytes
+            data = bytearray()
+            for part in parts:
+                packed = bytes.fromhex(part)
+                if len(packed) > 0xffff:
+                    break
+                data += len(packed).to_bytes(2, "big") + packed
+            else:
+                return bytes(data), flags | self._PACKED
+        return key.encode("utf-8"), flags
+
+    def _decode(self, data, flags):
+        if flags & self._PACKED:
+            parts = []
+            position = 0
+            while position < len(data):
+                end = position + 2 + int.from_bytes(data[position:position + 2], "big")
+                parts.append(data[position + 2:end].hex())
+                position = end
+            key = "_".join(parts)
+        else:
+            key = data.decode("utf-8")
+        if flags & self._PREFIXED:
+            key = self._prefix + key
+        return key
+
+    def _find(self, data, flags):
+        """Returns the slot where the key is (or would go) and its index, or -1"""
+        table, offsets, keys, info = self._table, self._offsets, self._keys, self._info
+        mask = len(table) - 1
+        slot = hash(data) & mask
+        while True:
+            index = table[slot]
+            if index < 0:
+                return slot, -1
+            if (info[index] & self._ENCODING_FLAGS == flags
+                    and keys[offsets[index]:offsets[index + 1]] == data):
+                return slot, index
+            slot = (slot + 1) & mask
+
+    def add_key(self, key, program_id, is_reply=False):
+        """Adds a comment by its key.  Returns whether it was new."""
+        data, flags = self._encode(key)
+        slot, index = self._find(data, flags)
+        if index >= 0:
+            return False
+
+        program_id = _intern(program_id)
+        program_index = self._program_indexes.get(program_id)
+        if program_index is None:
+            program_index = self._program_indexes[program_id] = len(self._program_ids)
+            self._program_ids.append(program_id)
+
+        self._table[slot] = len(self._info)
+        self._keys += data
+        self._offsets.append(len(self._keys))
+        self._info.append(program_index << self._FLAG_BITS | flags
+            | (self._REPLY if is_reply else 0))
+
+        # keep the table at most half full so probing stays short
+        if len(self._info) * 2 > len(self._table):
+            self._grow()
+        return True
+
+    def add(self, comment):
+        """Adds a comment, reply or handle for one.  Returns whether it was new."""
+        comment = handle(comment)
+        return self.add_key(comment.id, comment.program_id, comment.is_reply)
+
+    def _grow(self):
+        self._table = table = array("i", [-1]) * (len(self._table) * 2)
+        mask = len(table) - 1
+        for index in range(len(self._info)):
+            slot = hash(self._key_data(index)) & mask
+            while table[slot] >= 0:
+                slot = (slot + 1) & mask
+            table[slot] = index
+
+    def _key_data(self, index):
+        return bytes(self._keys[self._offsets[index]:self._offsets[index + 1]])
+
+    def _key(self, index):
+        return self._decode(self._key_data(index), self._info[index])
+
+    def _handle(self, index):
+        info = self._info[index]
+        return ProgramCommentHandle(self._key(index),
+            self._program_ids[info >> self._FLAG_BITS], bool(info & self._REPLY))
+
+    def __contains__(self, comment):
+        """``comment`` can be a key or anything with an ``id``, like a comment or handle"""
+        key = comment if isinstance(comment, str) else comment.id
+        return self._find(*self._encode(key))[1] >= 0
+
+    def __len__(self):
+        return len(self._info)
+
+    def keys(self):
+        """Iterates over the keys of the comments"""
+        return map(self._key, range(len(self)))
+
+    def handles(self):
+        """Iterates over ``ProgramCommentHandle``s for the comments"""
+        return map(self._handle, range(len(self)))
+
+    def __iter__(self):
+        """Iterates over the comments as ``ProgramComment``s and ``ProgramCommentReply``s"""
+        for comment_handle in self.handles():
+            yield comment_handle.content()
+
+    def memory_size(self):
+        """Roughly how many bytes the set's arrays take up"""
+        return sum(sys.getsizeof(part) for part in
+            [self._keys, self._offsets, self._info, self._table])
@@ -0,0 +1,228 @@
+"""
+Deleting or editing lots of comments at once, like when cleaning up spam
+
+    spam = Moderator(session, [by_author(spammer_kaid), matches(r"free robux")])
+    report = spam.run(discussion(program))
+    print(report.summary())
+
+Predicates are functions that take a comment's data (the dicts that
+``get_reply_data`` gives, which is also the metadata of program comments
+and replies) and return whether the comment should be moderated.  They only
+look at data we already have, so checking them doesn't send requests as
+long as the comments come with their data cached, which is the case for
+``Program.get_replies``, ``ProgramComment.get_replies`` and
+``Program.iter_new_replies``.
+
+Deleting a comment deletes its replies too, so replies to comments that are
+being deleted are left alone.
+"""
+
+import collections
+import re
+from datetime import datetime, timedelta, timezone
+
+from .utils import run_concurrently
+
+
+# predicates
+
+def by_author(*kaids):
+    """Matches comments written by any of the users with the kaids ``kaids``"""
+    kaids = frozenset(kaids)
+    return lambda data: data["authorKaid"] in kaids
+
+def matches(pattern, flags=re.IGNORECASE):
+    """Matches comments with text that the regex ``pattern`` can be found in"""
+    search = re.compile(pattern, flags).search
+    return lambda data: search(data["content"]) is not None
+
+def _parse_date(text):
+    for date_format in ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S.%fZ"]:
+        try:
+            return datetime.strptime(text, date_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    raise ValueError("{!r} isn't a date I know how to read".format(text))
+
+def _age(data):
+    return datetime.now(timezone.utc) - _parse_date(data["date"])
+
+def older_than(**kwargs):
+    """
+    Matches comments posted longer ago than ``timedelta(**kwargs)``, like
+    ``older_than(days=30)``
+    """
+    age = timedelta(**kwargs)
+    return lambda data: _age(data) > age
+
+def newer_than(**kwargs):
+    """Matches comments posted less than ``timedelta(**kwargs)`` ago"""
+    age = timedelta(**kwargs)
+    return lambda data: _age(data) < age
+
+def any_of(*predicates):
+    """Matches comments that any of ``predicates`` match"""
+    return lambda data: any(predicate(data) for predicate in predicates)
+
+
+class ModerationResult(collections.namedtuple("ModerationResult",
+        ["content", "action", "error"])):
+    """
+    What happened to one comment.  ``action`` is "delete" or "edit", or
+    "check" if the predicates raised on it, and ``error`` is the exception
+    if it failed, or None.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class ModerationReport:
+    """What a ``Moderator`` did (or, for a dry run, would have done)"""
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.checked = 0 # how many comments the predicates were checked on
+        self.results = []
+        # exceptions raised while going through the comments, like a page of
+        # them failing to download.  Going through the comments stops at the
+        # first one, since the iterator can't go on after raising.
+        self.errors = []
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.ok]
+
+    def summary(self):
+        """A short description of the report as a str"""
+        lines = ["{}checked {} comments, {} matched, {} succeeded, {} failed".format(
+            "(dry run) " if self.dry_run else "", self.checked,
+            sum(result.action != "check" for result in self.results),
+            len(self.succeeded), len(self.failed))]
+        for result in self.failed:
+            lines.append("  {} {}: {!r}".format(result.action, result.content.id, result.error))
+        for error in self.errors:
+            lines.append("  stopped early: {!r}".format(error))
+        return "\n".join(lines)
+
+
+class Moderator:
+    """
+    Deletes (or edits) every comment that all of its predicates match.
+    """
+    def __init__(self, session, predicates, edit=None, workers=4, dry_run=False):
+        """
+        Comments are deleted using the ``KASession`` ``session``, unless
+        ``edit`` is given, in which case they're edited to say
+        ``edit(data)`` instead.
+
+        Up to ``workers`` requests are sent at once, and they go through the
+        session's rate limiter, if it has one.  Give it one (see
+        ``KASession``) so a big cleanup won't get us throttled.  A
+        ``dry_run`` sends nothing, and just reports what would be done.
+        """
+        self.session = session
+        self.predicates = list(predicates)
+        self.edit = edit
+        self.workers = workers
+        self.dry_run = dry_run
+
+    def matches(self, data):
+        return all(predicate(data) for predicate in self.predicates)
+
+    def _data(self, comment):
+        # cached metadata is fine even if it's old, since authors and dates
+        # don't change (and someone who edited their spam is still a spammer).
+        # It's read once since workers can invalidate comments at any time.
+        metadata = comment._metadata
+        if metadata is not None:
+            return metadata
+        return comment.get_metadata()
+
+    def _parent_key(self, comment):
+        # only replies that know their parent, since asking KA costs a
+        # request (and fails if the parent was just deleted)
+        parent = getattr(comment, "_parent", None)
+        return None if parent is None else parent.id
+
+    def _apply(self, item):
+        comment, data = item
+        action = "delete" if self.edit is None else "edit"
+        try:
+            if not self.dry_run:
+                if self.edit is None:
+                    comment.delete(self.session)
+                else:
+                    comment.edit(self.session, self.edit(data))
+        except Exception as error:
+            return ModerationResult(comment, action, error)
+        return ModerationResult(comment, action, None)
+
+    def run(self, comments):
+        """
+        Moderates the comments (``ProgramComment``s, ``ProgramCommentReply``s
+        and so on) in the iterable ``comments``, returning a
+        ``ModerationReport``.  Comments are streamed, so ``comments`` can be
+        a generator going through a huge discussion.  Errors from
+        ``comments`` end up in the report's ``errors``, and errors from the
+        predicates are failed "check" results, instead of being raised, so
+        you always find out what was already done.
+        """
+        report = ModerationReport(self.dry_run)
+        deleting = set() # keys of the comments being deleted
+        unchecked = [] # results for comments the predicates raised on
+
+        def matching():
+            iterator = iter(comments)
+            while True:
+                try:
+                    comment = next(iterator)
+                    data = self._data(comment)
+                except StopIteration:
+                    return
+                except Exception as error:
+                    report.errors.append(error)
+                    return
+
+                report.checked += 1
+                if self._parent_key(comment) in deleting:
+                    continue # it goes when its parent does
+                try:
+                    matched = self.matches(data)
+                except Exception as error: # like a date we can't read
+                    unchecked.append(ModerationResult(comment, "check", error))
+                    continue
+                if matched:
+                    if self.edit is None:
+                        deleting.add(comment.id)
+                    yield comment, data
+
+        if self.dry_run: # nothing is sent, so there's no point in threads
+            report.results.extend(map(self._apply, matching()))
+        else:
+            report.results.extend(run_concurrently(self._apply, matching(), self.workers))
+        report.results.extend(unchecked)
+        return report
+
+
+def discussion(program):
+    """
+    Yields all the comments on a program, each followed by its replies, with
+    their data cached.  Costs a request per page of comments, and one per
+    comment that has replies.
+
+    Each comment's replies are downloaded before the comment is yielded, so
+    deleting the comment (say, in a ``Moderator`` worker) doesn't break
+    anything.
+    """
+    for comment in program.get_replies():
+        replies = []
+        if comment.get_metadata()["replyCount"]:
+            replies = list(comment.get_replies())
+        yield comment
+        yield from replies
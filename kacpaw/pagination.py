@@ -0,0 +1,99 @@
+"""
+Iteration over KA's cursor-paginated apis
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .tracing import operation as traced_operation
+
+
+class Paginator:
+    """
+    An iterator over the items of a paginated api, like the comments on a
+    program.
+
+    KA pages look like ``{"feedback": [...], "cursor": "...", "isComplete":
+    false}``, and the next page is requested by sending the cursor back.
+    """
+    def __init__(self, transport, url, params=None, items_key="feedback",
+                 cursor=None, max_items=None, prefetch=False, operation="Paginator"):
+        """
+        ``transport`` is used to GET ``url`` with the query parameters
+        ``params``.  Items are taken from the ``items_key`` list of each page.
+
+        To pick up where an earlier paginator left off, pass its ``cursor``.
+        ``max_items`` stops iteration after that many items.  If ``prefetch``
+        is true, the next page is requested in a background thread while the
+        current one is being iterated over.
+
+        Page requests show up in ``kacpaw.trace`` as ``operation + " page"``.
+        """
+        self.transport = transport
+        self.url = url
+        self.params = dict(params or {})
+        self.items_key = items_key
+        self.max_items = max_items
+        self.prefetch = prefetch
+        self.operation = operation
+
+        # The cursor of the page that items are currently coming from (None
+        # for the first page).  Resuming from it may repeat some items, since
+        # cursors only point to whole pages.
+        self.cursor = cursor
+        self.complete = False
+        self.pages_fetched = 0
+        self.items_yielded = 0
+
+        self._items = self._iter_items()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    def close(self):
+        """Stops iteration, abandoning any prefetched page"""
+        self._items.close()
+
+    def _fetch(self, cursor):
+        params = self.params if cursor is None else dict(self.params, cursor=cursor)
+        with traced_operation(self.operation + " page"):
+            resp = self.transport.get(self.url, params=params)
+        resp.raise_for_status()
+        self.pages_fetched += 1
+        return resp.json()
+
+    def _wants_more(self, page):
+        if page["isComplete"]:
+            return False
+        return (self.max_items is None or
+            self.items_yielded + len(page[self.items_key]) < self.max_items)
+
+    def _iter_items(self):
+        if self.max_items is not None and self.max_items <= 0:
+            return # don't fetch a page we won't use
+        executor = ThreadPoolExecutor(max_workers=1) if self.prefetch else None
+        try:
+            page = self._fetch(self.cursor)
+            while True:
+                next_page = None
+                if executor is not None and self._wants_more(page):
+                    next_page = executor.submit(self._fetch, page["cursor"])
+
+                for item in page[self.items_key]:
+                    if self.max_items is not None and self.items_yielded >= self.max_items:
+                        return
+                    self.items_yielded += 1
+                    yield item
+
+                if page["isComplete"]:
+                    self.cursor = None
+                    self.complete = True
+                    return
+
+                self.cursor = page["cursor"]
+                page = self._fetch(self.cursor) if next_page is None else next_page.result()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
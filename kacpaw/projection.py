@@ -0,0 +1,129 @@
+"""
+Pulling a few items out of json responses without holding on to the rest
+
+When ijson is installed, big responses are parsed as they are downloaded, so
+the full json never has to be in memory at once.  Without it, the response
+is parsed normally and everything we don't want is thrown away right after.
+
+Streaming stops as soon as everything we want has been found.  If there isn't
+much of the response left by then, it's read and thrown away so the
+connection can be kept alive, since that's cheaper than making a new one.
+
+A transport with a ``ResponseCache`` reads whole responses to cache them, so
+nothing is streamed through one.  You still get conditional requests, and
+only the items you want are kept.
+"""
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Responses bigger than this many bytes (or of unknown size) are parsed
+# incrementally when ijson is available
+STREAMING_THRESHOLD = 64 * 1024
+# When we stop streaming early, up to this many bytes of the rest of the
+# response are read to save the connection.  Any more and it's closed.
+DRAIN_LIMIT = 64 * 1024
+
+
+def project(data, paths):
+    """
+    Given a dict of names to dict paths, returns a dict of names to the items
+    at those paths in ``data``.  Items that don't exist are None.
+    """
+    projected = {}
+    for name, path in paths.items():
+        value = data
+        for level in path:
+            if not isinstance(value, dict) or level not in value:
+                value = None
+                break
+            value = value[level]
+        projected[name] = value
+    return projected
+
+
+def project_response(resp, paths):
+    """
+    Like ``project``, but takes the json from the ``requests.Response``
+    ``resp``.  For streaming to do any good, the request should have been
+    sent with ``stream=True``.
+    """
+    size = resp.headers.get("Content-Length")
+    if ijson is not None and (size is None or int(size) > STREAMING_THRESHOLD):
+        body = _ResponseFile(resp)
+        try:
+            projected = _project_stream(body, paths)
+            body.drain(DRAIN_LIMIT)
+            return projected
+        finally:
+            # gives the connection back to the pool if the whole body was
+            # read, and closes it otherwise
+            resp.close()
+    return project(resp.json(), paths)
+
+
+class _ResponseFile:
+    """A file-like wrapper around a response's body, for ijson"""
+    def __init__(self, resp, chunk_size=16 * 1024):
+        self._chunks = resp.iter_content(chunk_size)
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def drain(self, limit):
+        """
+        Reads and throws away the rest of the body, giving up (and returning
+        False) once more than ``limit`` bytes have been read
+        """
+        self._buffer = b""
+        drained = 0
+        for chunk in self._chunks:
+            drained += len(chunk)
+            if drained > limit:
+                return False
+        return True
+
+
+_CONTAINER_STARTS = {"start_map", "start_array"}
+_CONTAINER_ENDS = {"end_map", "end_array"}
+
+
+def _project_stream(fp, paths):
+    # ijson names positions like "revision.code", so we match on those
+    wanted = {".".join(path): name for name, path in paths.items()}
+    projected = dict.fromkeys(paths)
+    builder = name = None
+    depth = 0
+
+    for prefix, event, value in ijson.parse(fp, use_float=True):
+        if builder is not None: # we're in the middle of a wanted dict or list
+            builder.event(event, value)
+            depth += (event in _CONTAINER_STARTS) - (event in _CONTAINER_ENDS)
+            if depth == 0:
+                projected[name] = builder.value
+                builder = None
+        elif prefix in wanted and event != "map_key" and event not in _CONTAINER_ENDS:
+            if event in _CONTAINER_STARTS:
+                name = wanted.pop(prefix)
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                depth = 1
+            else:
+                projected[wanted.pop(prefix)] = value
+
+        if not wanted and builder is None:
+            break # no need to read the rest
+
+    return projected
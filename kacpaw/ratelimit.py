@@ -0,0 +1,114 @@
+"""
+Rate limiting and retrying, so bots can go fast without getting blocked
+"""
+
+import email.utils
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class RateLimiter:
+    """
+    A token bucket that adapts its rate to how KA responds.
+
+    Every request takes a token, and tokens come back at ``rate`` per second.
+    When KA throttles us, the rate is cut (multiplied by ``decrease``), and
+    every successful request adds ``increase`` back, up to ``max_rate``.  One
+    limiter can be shared between sessions and threads.
+    """
+    def __init__(self, rate=10.0, burst=None, min_rate=0.1, max_rate=None,
+                 increase=0.05, decrease=0.5):
+        """
+        ``rate`` is the starting rate, in requests per second, and ``burst``
+        is how many requests can be sent at once after sitting idle (by
+        default, a second's worth).  ``max_rate`` defaults to ``rate``.
+        """
+        self.rate = float(rate)
+        self.burst = burst or max(1.0, self.rate)
+        self.min_rate = min_rate
+        self.max_rate = self.rate if max_rate is None else max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+        self.requests = 0
+        self.throttled_count = 0
+        self.waited = 0.0 # total seconds spent waiting for tokens
+
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Takes a token, returning how long to wait until it's ours"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            # Tokens can go negative, which reserves future tokens.  That keeps
+            # waiting requests in line instead of having them fight.
+            self._tokens -= 1
+            self.requests += 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            self.waited += wait
+            return wait
+
+    def acquire(self):
+        """Blocks until a request can be sent"""
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    def throttled(self):
+        """Tells the limiter that KA throttled (or choked on) a request"""
+        with self._lock:
+            self.throttled_count += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def succeeded(self):
+        """Tells the limiter that a request went through fine"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def stats(self):
+        """A dict with the current rate and some counters"""
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "requests": self.requests,
+                "throttled": self.throttled_count,
+                "waited": self.waited
+            }
+
+
+def retry_after(resp):
+    """
+    How many seconds a response's Retry-After header says to wait, or None
+    if it doesn't have a (valid) one.
+    """
+    value = resp.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try: # it can also be an http date
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff(attempt, base=0.5, cap=60.0):
+    """
+    Seconds to wait before retry number ``attempt`` (starting at 0):
+    exponential backoff with "full jitter", so a bunch of clients that were
+    throttled at once don't all come back at once.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
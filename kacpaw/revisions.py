@@ -0,0 +1,249 @@
+"""
+A local store of program code revisions, for keeping track of how programs
+change over time
+
+    store = RevisionStore("revisions")
+    store.snapshot_many(program_ids) # say, once a day
+    for program_id in store.changed_since(yesterday):
+        print(program_id, "changed")
+
+Code is stored by its sha256 hash, so code that's already stored (say, the
+same revision snapshotted again, or a spin-off that nobody changed) doesn't
+take any more space.  New code is stored as a delta against the program's
+previous revision when that's smaller, which it usually is.  Blobs are
+zlib-compressed and appended to a pack file that is read with mmap, and an
+SQLite index keeps track of where everything is and when each program
+changed, so questions about history don't have to touch the blobs at all.
+"""
+
+import difflib
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from .content import Program
+
+
+class RevisionStore:
+    """Revisions of programs' code, stored in the directory ``path``"""
+    # After this many deltas in a row, code is stored in full again, so
+    # reading a revision never has to apply too many deltas
+    max_chain = 20
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        with self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    base TEXT, -- the blob this is a delta against, if it's a delta
+                    depth INTEGER NOT NULL -- how many deltas have to be applied
+                );
+                -- every time a program's code was seen to change
+                CREATE TABLE IF NOT EXISTS revisions (
+                    program_id TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    time REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS revisions_program ON revisions (program_id, time);
+                CREATE INDEX IF NOT EXISTS revisions_time ON revisions (time);
+                -- the latest code of each program
+                CREATE TABLE IF NOT EXISTS programs (
+                    program_id TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    checked REAL NOT NULL
+                );
+            """)
+
+        self._pack = open(os.path.join(path, "blobs.pack"), "a+b")
+        self._map = None
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+            self._pack.close()
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # reading
+
+    def _read_raw(self, offset, length):
+        # The pack only grows, so remap it when we need something past the
+        # end of the current map
+        if self._map is None or offset + length > len(self._map):
+            self._pack.flush()
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._pack.fileno(), 0, access=mmap.ACCESS_READ)
+        return zlib.decompress(self._map[offset:offset + length])
+
+    def _load(self, code_hash):
+        """Returns the code with the hash ``code_hash`` as bytes"""
+        # follow the chain of deltas back to a full copy...
+        chain = []
+        while code_hash is not None:
+            row = self._db.execute("SELECT offset, length, base FROM blobs WHERE hash = ?",
+                (code_hash,)).fetchone()
+            if row is None:
+                raise KeyError(code_hash)
+            offset, length, code_hash = row
+            chain.append(self._read_raw(offset, length))
+
+        # ...then apply the deltas on top of it
+        code = chain.pop()
+        while chain:
+            code = _apply_delta(code, chain.pop())
+        return code
+
+    def code(self, code_hash):
+        """Gets code by its hash"""
+        with self._lock:
+            return self._load(code_hash).decode("utf-8")
+
+    def __contains__(self, code_hash):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM blobs WHERE hash = ?",
+                (code_hash,)).fetchone() is not None
+
+    def latest(self, program_id):
+        """The hash of a program's latest code, or None if it's never been snapshotted"""
+        with self._lock:
+            row = self._db.execute("SELECT hash FROM programs WHERE program_id = ?",
+                (program_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def history(self, program_id):
+        """A list of ``(time, hash)`` for each change to a program's code, oldest first"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT time, hash FROM revisions WHERE program_id = ? ORDER BY time",
+                (program_id,)).fetchall()
+
+    def changed_since(self, when):
+        """
+        Returns the ids of the programs whose code changed since ``when`` (a
+        ``datetime`` or a ``time.time()`` timestamp).  The first snapshot of
+        a program counts as a change.
+        """
+        if isinstance(when, datetime):
+            when = when.timestamp()
+        with self._lock:
+            return [program_id for program_id, in self._db.execute(
+                "SELECT DISTINCT program_id FROM revisions WHERE time >= ?", (when,))]
+
+    # writing
+
+    def _write_blob(self, code_hash, code, base_hash):
+        full = zlib.compress(code)
+        blob, depth = full, 0
+        if base_hash is not None:
+            base_depth, = self._db.execute("SELECT depth FROM blobs WHERE hash = ?",
+                (base_hash,)).fetchone()
+            if base_depth < self.max_chain:
+                delta = zlib.compress(_make_delta(self._load(base_hash), code))
+                if len(delta) < len(full):
+                    blob, depth = delta, base_depth + 1
+        if depth == 0:
+            base_hash = None
+
+        self._pack.seek(0, os.SEEK_END)
+        offset = self._pack.tell()
+        self._pack.write(blob)
+        self._pack.flush()
+        self._db.execute("INSERT INTO blobs VALUES (?, ?, ?, ?, ?)",
+            (code_hash, offset, len(blob), base_hash, depth))
+
+    def add(self, program_id, code, when=None):
+        """
+        Records that a program has the code ``code`` (a str) as of ``when``
+        (a ``time.time()`` timestamp, by default now).  Returns whether the
+        code changed.  If it didn't, this costs a hash and a tiny update.
+        """
+        when = time.time() if when is None else when
+        data = code.encode("utf-8")
+        code_hash = hashlib.sha256(data).hexdigest()
+
+        with self._lock, self._db:
+            row = self._db.execute("SELECT hash FROM programs WHERE program_id = ?",
+                (program_id,)).fetchone()
+            previous_hash = None if row is None else row[0]
+            if previous_hash == code_hash:
+                self._db.execute("UPDATE programs SET checked = ? WHERE program_id = ?",
+                    (when, program_id))
+                return False
+
+            if self._db.execute("SELECT 1 FROM blobs WHERE hash = ?",
+                    (code_hash,)).fetchone() is None:
+                self._write_blob(code_hash, data, previous_hash)
+            self._db.execute("INSERT OR REPLACE INTO programs VALUES (?, ?, ?)",
+                (program_id, code_hash, when))
+            self._db.execute("INSERT INTO revisions VALUES (?, ?, ?)",
+                (program_id, code_hash, when))
+            return True
+
+    def snapshot(self, program, when=None):
+        """
+        Stores a ``Program``'s current code (from its metadata).  Returns
+        whether it changed since the last snapshot.
+        """
+        return self.add(program.id, program.get_metadata()["revision"]["code"], when)
+
+    def snapshot_many(self, program_ids, workers=8, when=None):
+        """
+        Snapshots lots of programs concurrently (only their code is kept from
+        the responses, see ``Program.fetch_many``).  Returns a dict of
+        program ids to whether they changed, leaving out the programs that
+        couldn't be fetched.
+        """
+        changed = {}
+        for result in Program.fetch_many(program_ids, workers, fields=["code"]):
+            if result.ok and result.metadata["code"] is not None:
+                changed[result.content.id] = self.add(result.content.id,
+                    result.metadata["code"], when)
+        return changed
+
+
+def _make_delta(base, code):
+    """
+    Makes a delta that turns the bytes ``base`` into ``code``.  It's json: a
+    list of ``[start, end]`` ranges of lines to copy from ``base`` and
+    strings of new text.
+    """
+    base_lines = base.decode("utf-8").splitlines(keepends=True)
+    lines = code.decode("utf-8").splitlines(keepends=True)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, base_start, base_end, start, end in matcher.get_opcodes():
+        if tag == "equal":
+            delta.append([base_start, base_end])
+        elif start != end: # replace or insert (deleting just means not copying)
+            delta.append("".join(lines[start:end]))
+    return json.dumps(delta, separators=(",", ":")).encode("utf-8")
+
+def _apply_delta(base, delta):
+    base_lines = base.decode("utf-8").splitlines(keepends=True)
+    parts = []
+    for op in json.loads(delta.decode("utf-8")):
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(base_lines[op[0]:op[1]])
+    return "".join(parts).encode("utf-8")
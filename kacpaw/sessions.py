@@ -1,23 +1,144 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
 import requests
 
 from kacpaw.content import User
+from kacpaw.ratelimit import RateLimiter, retry_after, backoff
+from kacpaw.tracing import traced, add_response_hook
 from kacpaw.utils import kaurl
 
 class KASession(requests.Session): # todo: attempt to use the OAuth flow again (in a different class)
     """A session that is logged into KA"""
-    def __init__(self, username, password, user_agent="Ben-Burrill-Bot Python"):
+    # statuses that mean KA wants us to slow down
+    throttle_statuses = {429, 503}
+    # statuses worth retrying.  Server errors are only retried for idempotent
+    # methods, since we don't want to post the same comment twice
+    retry_statuses = {429, 500, 502, 503, 504}
+    idempotent_methods = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+    # statuses that mean we aren't logged in anymore
+    reauth_statuses = {401}
+    # A 403 usually just means we aren't allowed to do something, which
+    # logging in again won't fix, but it's also what KA says about a bad
+    # fkey.  403s with bodies that match this get a login too.  Just "login"
+    # isn't enough, since plenty of error pages have a login link.
+    auth_failure_pattern = re.compile(r"fkey|not logged in", re.IGNORECASE)
+
+    user = None
+    _user_data = None
+    _credentials = None
+    _login_count = 0 # so threads that all got 401s only log in once
+
+    def __init__(self, username=None, password=None, user_agent="Ben-Burrill-Bot Python",
+                 rate_limiter=None, max_retries=5, backoff_base=0.5):
         """
         To log into KA, you need a username and password.
         ``username`` is your KA username although I think it can also be your email.
         ``password`` is your KA password.  I don't think the password you use with your email works.
         You can also provide a user_agent to use for all requests.
+
+        If you leave out the username, the session isn't logged in until you
+        call ``login`` yourself.  This is handy if you need to set the
+        session up (mount adapters, etc) before it sends any requests.
+
+        If ``rate_limiter`` (a ``kacpaw.ratelimit.RateLimiter``, which you
+        can share with other sessions and transports) is given, every request
+        waits its turn from it.  By default requests aren't limited, like
+        they always were.  Throttled and failed requests
+        are retried up to ``max_retries`` times, waiting as long as KA's
+        Retry-After header says, or with jittered exponential backoff
+        starting at ``backoff_base`` seconds.
         """
         super().__init__()
         self.headers["User-Agent"] = user_agent
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.retry_count = 0
+        self._login_lock = threading.RLock()
+        self._local = threading.local() # whether this thread is logging in
+        add_response_hook(self)
+
+        if username is not None:
+            self.login(username, password)
 
-        self.login(username, password)
+    def request(self, method, url, *args, **kwargs):
+        """
+        ``requests.Session.request``, plus rate limiting and retries.  If we
+        know the username and password and KA says we aren't logged in, the
+        session logs in again (once) and resends the request.
+        """
+        attempt = 0
+        reauthed = False
+        while True:
+            login_count = self._login_count
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            resp = super().request(method, url, *args, **kwargs)
+            if not reauthed and self._needs_login(resp):
+                resp.close()
+                with self._login_lock:
+                    # if another thread logged in since we sent the request,
+                    # its login will do
+                    if self._login_count == login_count:
+                        self.login(*self._credentials)
+                reauthed = True
+                continue
+            if not self._should_retry(method, resp, attempt):
+                break
+
+            if resp.status_code in self.throttle_statuses and self.rate_limiter is not None:
+                self.rate_limiter.throttled()
+            delay = retry_after(resp)
+            resp.close() # give the connection back to the pool
+            time.sleep(backoff(attempt, self.backoff_base) if delay is None else delay)
+            attempt += 1
+            self.retry_count += 1
+
+        if self.rate_limiter is not None:
+            if resp.status_code in self.throttle_statuses:
+                self.rate_limiter.throttled()
+            elif resp.status_code < 500:
+                self.rate_limiter.succeeded()
+        return resp
+
+    def _needs_login(self, resp):
+        if self._credentials is None or getattr(self._local, "logging_in", False):
+            return False
+        if resp.status_code in self.reauth_statuses:
+            return True
+        return resp.status_code == 403 and self.auth_failure_pattern.search(resp.text) is not None
+
+    def _should_retry(self, method, resp, attempt):
+        if attempt >= self.max_retries or resp.status_code not in self.retry_statuses:
+            return False
+        return resp.status_code == 429 or method.upper() in self.idempotent_methods
+
+    def stats(self):
+        """
+        Rate limiting stats (see ``RateLimiter.stats``, left out without a
+        ``rate_limiter``) and the number of retries
+        """
+        stats = {} if self.rate_limiter is None else self.rate_limiter.stats()
+        return dict(stats, retries=self.retry_count)
 
+    @traced
     def login(self, username, password):
+        with self._login_lock:
+            self._local.logging_in = True
+            try:
+                self._login(username, password)
+            finally:
+                self._local.logging_in = False
+            # remembered so we can log in again if the session expires
+            self._credentials = (username, password)
+            self._login_count += 1
+
+    def _login(self, username, password):
         self.get(kaurl("login")).raise_for_status()
 
         # I'm a little unclear about the nature of KA fkeys, but you can
@@ -30,18 +151,90 @@ class KASession(requests.Session): # todo: attempt to use the OAuth flow again (
             "fkey": fkey
         }).raise_for_status()
 
-        self.user = User(self.user_id)
+        # we might be someone else now
+        self._user_data = None
+        self.user = User(self.user_data["kaid"])
+
+    def save(self, path):
+        """
+        Saves the session's login (cookies, fkey and user data) to a json file
+        at ``path``, so that ``KASession.load`` can skip logging in.  The file
+        is as good as a password while the session lasts, so it's only
+        readable by you.  It's replaced atomically, so it's safe for other
+        processes to load it while it's being saved.
+        """
+        state = {
+            "cookies": [{
+                "name": cookie.name,
+                "value": cookie.value,
+                "domain": cookie.domain,
+                "path": cookie.path,
+                "expires": cookie.expires,
+                "secure": cookie.secure
+            } for cookie in self.cookies],
+            "fkey": self.headers.get("x-ka-fkey"),
+            "user_id": None if self.user is None else self.user.id,
+            "user_data": self._user_data
+        }
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".kasession-")
+        try:
+            with os.fdopen(fd, "w") as file: # mkstemp files are private already
+                json.dump(state, file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, username=None, password=None, **kwargs):
+        """
+        Makes a session from a file written by ``save``, without sending any
+        requests.  Other keyword arguments go to ``KASession``.
+
+        Whether the saved login still works isn't checked until the session
+        is used.  If you give the username and password too, the session
+        logs in again when KA rejects the saved one.
+        """
+        with open(path) as file:
+            state = json.load(file)
+
+        session = cls(**kwargs)
+        for cookie in state["cookies"]:
+            session.cookies.set(**cookie)
+        if state["fkey"] is not None:
+            session.headers["x-ka-fkey"] = state["fkey"]
+        if state["user_id"] is not None:
+            session.user = User(state["user_id"])
+        session._user_data = state.get("user_data")
+        if username is not None:
+            session._credentials = (username, password)
+        return session
 
     # note that although there is a user_id property which may sound like the
     # id from Content subclasses, KASessions are not in any way related to
     # content.  There is no id property for one, and sessions cannot be tested
     # for equality, hashed, etc...
+    @property
+    def user_data(self):
+        """
+        The logged in user's data from api/v1/user, like their kaid, nickname
+        and username.  It's only requested once, and is kept until the next
+        login.
+        """
+        if self._user_data is None:
+            # api/v1/user gives info on the authorized user by default
+            resp = self.get(kaurl("api/v1/user"))
+            resp.raise_for_status()
+            self._user_data = resp.json()
+        return self._user_data
+
     @property
     def user_id(self):
         """
         Gets the user id of the logged in user
         """
-        # api/v1/user gives info on the authorized user by default
-        resp = self.get(kaurl("api/v1/user"))
-        resp.raise_for_status()
-        return resp.json()["kaid"]
\ No newline at end of file
+        if self.user is not None:
+            return self.user.id
+        return self.user_data["kaid"]
\ No newline at end of file
@@ -0,0 +1,547 @@
+"""
+A local stand-in for the parts of KA's api that KACPAW uses
+
+This lets KACPAW be tested and benchmarked without a network connection (or
+without annoying KA)::
+
+    with FakeKA(latency=0.01) as fake:
+        fake.add_user("bot", "password")
+        program_id = fake.add_program(comments=50, replies=10)
+
+        session = fake.session("bot", "password")
+        program = Program(program_id)
+        program.transport = fake.install(Transport())
+
+        program.reply(session, "Hello, fake KA!")
+
+It only pretends to be KA as far as KACPAW is concerned.  Responses have
+the fields KACPAW uses and a few others, but they are nowhere near complete.
+"""
+
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from requests.adapters import HTTPAdapter
+
+from kacpaw.sessions import KASession
+from kacpaw.utils import KA_DOMAIN
+
+
+class _FakeKAAdapter(HTTPAdapter):
+    """A transport adapter that sends requests for KA to a FakeKA instead"""
+    def __init__(self, fake_url, **kwargs):
+        super().__init__(**kwargs)
+        self.fake_url = fake_url
+
+    def send(self, request, **kwargs):
+        # copy, so that requests still thinks it's talking to KA (which
+        # matters for cookies)
+        request = request.copy()
+        request.url = self.fake_url + request.url[len(KA_DOMAIN):]
+        return super().send(request, **kwargs)
+
+
+class _FakeKAError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # so connections can be kept alive
+    # otherwise Nagle's algorithm adds ~40ms to every kept-alive response
+    disable_nagle_algorithm = True
+    fake = None # set on subclasses made by FakeKA.start
+
+    def setup(self):
+        super().setup()
+        with self.fake.lock:
+            self.fake.connections += 1
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            pass # clients hang up early sometimes, like when they stop streaming
+
+    def do_GET(self):
+        self.fake._handle(self)
+
+    do_POST = do_PUT = do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        pass # a request log would just be noise in test output
+
+
+class FakeKA:
+    """
+    A fake KA server, running in a background thread.
+
+    Every request that is handled is recorded in ``requests`` as a ``(method,
+    path)`` tuple, so you can check how many requests something sends.
+    """
+    # (method, path regex, handler method name)
+    routes = [
+        ("GET", r"/login", "_get_login"),
+        ("POST", r"/login", "_post_login"),
+        ("GET", r"/api/v1/user", "_get_current_user"),
+        ("GET", r"/api/internal/user/profile", "_get_profile"),
+        ("POST", r"/api/internal/user/profile", "_edit_profile"),
+        ("GET", r"/api/internal/scratchpads/(\w+)", "_get_program"),
+        ("PUT", r"/api/internal/scratchpads/(\w+)", "_edit_program"),
+        ("DELETE", r"/api/internal/scratchpads/(\w+)", "_delete_program"),
+        ("GET", r"/api/internal/discussions/scratchpad/(\w+)/comments", "_get_comments"),
+        ("POST", r"/api/internal/discussions/scratchpad/(\w+)/comments", "_post_comment"),
+        ("PUT", r"/api/internal/discussions/scratchpad/(\w+)/comments/(\w+)", "_edit_comment"),
+        ("GET", r"/api/internal/discussions/(\w+)/replies", "_get_replies"),
+        ("POST", r"/api/internal/discussions/(\w+)/replies", "_post_reply"),
+        ("DELETE", r"/api/internal/feedback/(\w+)", "_delete_comment"),
+    ]
+
+    def __init__(self, latency=0, error_rate=0, seed=None, error_status=503, retry_after=None):
+        """
+        ``latency`` is how many seconds each request takes.  It can also be a
+        function that returns a number of seconds, like ``lambda:
+        random.uniform(0.01, 0.05)``.  ``error_rate`` is the chance that any
+        request gets an ``error_status`` (with a Retry-After header, if
+        ``retry_after`` isn't None) instead of being handled.  ``seed`` seeds
+        the random errors.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+
+        self.lock = threading.RLock()
+        self.users = {} # kaid -> profile
+        self.passwords = {} # kaid -> password
+        self.programs = {} # program id -> metadata
+        self.comments = {} # key -> data, for comments and replies
+        self.program_comments = {} # program id -> comment keys, oldest first
+        self.replies = {} # comment key -> reply keys, oldest first
+        self.parents = {} # reply or comment key -> comment key or program id
+        self.fkeys = set()
+        self.sessions = {} # auth token -> (kaid, fkey)
+        self.requests = []
+        self.connections = 0 # how many connections have been made to us
+
+        self._ids = itertools.count(4500000000000000)
+        self._time = datetime(2016, 1, 1)
+        self._default_author = None
+        self.server = None
+
+    # running the server
+
+    def start(self):
+        """Starts the server in a background thread, returning self"""
+        handler = type("Handler", (_Handler,), {"fake": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def url(self):
+        """The url of the server, like ``http://127.0.0.1:12345``"""
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def install(self, target):
+        """
+        Makes ``target`` send requests for KA to this server.  ``target`` can
+        be a ``requests.Session`` (like a ``KASession``), a
+        ``kacpaw.Transport`` or a ``kacpaw.aio.AsyncTransport`` (like an
+        ``AsyncKASession``).  Returns ``target``.
+        """
+        if hasattr(target, "base_url"): # an AsyncTransport
+            target.base_url = self.url
+            return target
+
+        session = getattr(target, "session", target)
+        # keep the pool and retry settings of whatever adapter was there
+        old_adapter = session.get_adapter(KA_DOMAIN)
+        pool_size = getattr(old_adapter, "_pool_maxsize", 10)
+        session.mount(KA_DOMAIN, _FakeKAAdapter(self.url,
+            pool_connections=getattr(old_adapter, "_pool_connections", 10),
+            pool_maxsize=pool_size,
+            max_retries=getattr(old_adapter, "max_retries", 0)
+        ))
+        return target
+
+    def session(self, username, password, **kwargs):
+        """Returns a ``KASession`` logged into this server"""
+        session = self.install(KASession(**kwargs))
+        session.login(username, password)
+        return session
+
+    def expire_sessions(self):
+        """Logs everyone out, like KA does when a login gets old"""
+        with self.lock:
+            self.sessions.clear()
+
+    @property
+    def request_count(self):
+        return len(self.requests)
+
+    def reset_requests(self):
+        with self.lock:
+            del self.requests[:]
+
+    # setting up data
+
+    def _now(self):
+        # a fake clock that ticks a second every time it's read, so
+        # everything has a distinct, increasing date
+        with self.lock:
+            self._time += timedelta(seconds=1)
+            return self._time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def _new_key(self):
+        return "kaencrypted_" + uuid.uuid4().hex
+
+    def add_user(self, username, password="password", nickname=None, bio="", email=None):
+        """Adds a user, returning their kaid"""
+        with self.lock:
+            kaid = "kaid_{}".format(next(self._ids))
+            self.users[kaid] = {
+                "kaid": kaid,
+                "username": username,
+                "nickname": nickname or username,
+                "bio": bio,
+                "email": email or "{}@example.com".format(username)
+            }
+            self.passwords[kaid] = password
+            return kaid
+
+    def _author(self, author):
+        with self.lock:
+            if author is not None:
+                return author
+            if self._default_author is None:
+                self._default_author = self.add_user("fake_author")
+            return self._default_author
+
+    def add_program(self, title="Fake Program", code="", author=None,
+                    comments=0, replies=0, program_id=None):
+        """
+        Adds a program, returning its id.  ``comments`` comments are posted on
+        it, each with ``replies`` replies.
+        """
+        with self.lock:
+            program_id = str(program_id or next(self._ids))
+            author = self._author(author)
+            self.programs[program_id] = {
+                "id": program_id,
+                "kaid": author,
+                "title": title,
+                "url": "{}/computer-programming/fake/{}".format(KA_DOMAIN, program_id),
+                "width": 400,
+                "height": 400,
+                "userAuthoredContentType": "pjs",
+                "imageUrl": "{}/computer-programming/fake/{}/latest.png".format(KA_DOMAIN, program_id),
+                "created": self._now(),
+                "revision": {
+                    "id": str(next(self._ids)),
+                    "code": code,
+                    "created": self._now()
+                }
+            }
+            self.program_comments[program_id] = []
+
+            for comment_number in range(comments):
+                key = self.add_comment(program_id, "Comment {}".format(comment_number))
+                for reply_number in range(replies):
+                    self.add_reply(key, "Reply {}".format(reply_number))
+            return program_id
+
+    def add_comment(self, program_id, text, author=None):
+        """Posts a comment on a program, returning its key"""
+        with self.lock:
+            key = self._new_key()
+            self.comments[key] = self._comment_data(key, text, self._author(author))
+            self.program_comments[program_id].append(key)
+            self.replies[key] = []
+            self.parents[key] = program_id
+            return key
+
+    def add_reply(self, comment_key, text, author=None):
+        """Replies to a comment, returning the reply's key"""
+        with self.lock:
+            key = self._new_key()
+            self.comments[key] = self._comment_data(key, text, self._author(author))
+            self.replies[comment_key].append(key)
+            self.comments[comment_key]["replyCount"] += 1
+            self.parents[key] = comment_key
+            return key
+
+    def _comment_data(self, key, text, author):
+        return {
+            "key": key,
+            "content": text,
+            "authorKaid": author,
+            "authorNickname": self.users[author]["nickname"],
+            "date": self._now(),
+            "lastAnswerDate": None,
+            "replyCount": 0,
+            "sumVotesIncremented": 1
+        }
+
+    # handling requests
+
+    def _handle(self, handler):
+        method = handler.command
+        split = urlsplit(handler.path)
+        query = {name: values[-1] for name, values in parse_qs(split.query).items()}
+        body = handler.rfile.read(int(handler.headers.get("Content-Length") or 0))
+
+        with self.lock:
+            self.requests.append((method, split.path))
+
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+
+        headers = {}
+        try:
+            with self.lock:
+                if self.error_rate and self._random.random() < self.error_rate:
+                    if self.retry_after is not None:
+                        headers["Retry-After"] = str(self.retry_after)
+                    raise _FakeKAError(self.error_status, "Fake KA is pretending to be overloaded")
+                status, payload = 200, self._dispatch(method, split.path, query, body,
+                    handler.headers, headers)
+        except _FakeKAError as error:
+            status, payload = error.status, {"error": str(error)}
+        except Exception as error: # a bug in the fake shouldn't hang the client
+            status, payload = 500, {"error": repr(error)}
+
+        # handlers return strs for pages that are html instead of json
+        content_type = "text/html" if isinstance(payload, str) else "application/json"
+        data = (payload if isinstance(payload, str) else json.dumps(payload)).encode("utf-8")
+        if method == "GET" and status == 200:
+            etag = headers["ETag"] = '"{}"'.format(hashlib.sha1(data).hexdigest())
+            if handler.headers.get("If-None-Match") == etag:
+                status, data = 304, b""
+
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        if status != 304:
+            handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _dispatch(self, method, path, query, body, request_headers, response_headers):
+        for route_method, pattern, handler_name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                request = {
+                    "query": query,
+                    "body": body,
+                    "headers": request_headers,
+                    "response_headers": response_headers
+                }
+                return getattr(self, handler_name)(request, *match.groups())
+        raise _FakeKAError(404, "No such page")
+
+    def _json_body(self, request):
+        try:
+            return json.loads(request["body"].decode("utf-8"))
+        except ValueError:
+            raise _FakeKAError(400, "Expected a json body")
+
+    def _cookies(self, request):
+        return {name: morsel.value for name, morsel in
+            SimpleCookie(request["headers"].get("Cookie", "")).items()}
+
+    def _logged_in_user(self, request, check_fkey=True):
+        token = self._cookies(request).get("KAAS")
+        if token not in self.sessions:
+            raise _FakeKAError(401, "Not logged in")
+        kaid, fkey = self.sessions[token]
+        if check_fkey and request["headers"].get("x-ka-fkey") != fkey:
+            raise _FakeKAError(403, "Bad fkey")
+        return kaid
+
+    def _check_author(self, request, kaid):
+        if self._logged_in_user(request) != kaid:
+            raise _FakeKAError(403, "That's not yours")
+
+    # login and users
+
+    def _get_login(self, request):
+        fkey = uuid.uuid4().hex
+        self.fkeys.add(fkey)
+        request["response_headers"]["Set-Cookie"] = "fkey={}; Path=/".format(fkey)
+        return "<html>Log in to Fake KA</html>"
+
+    def _post_login(self, request):
+        form = {name: values[-1] for name, values in
+            parse_qs(request["body"].decode("utf-8")).items()}
+        if form.get("fkey") not in self.fkeys:
+            raise _FakeKAError(403, "Bad fkey")
+
+        for kaid, profile in self.users.items():
+            if (form.get("identifier") in (profile["username"], profile["email"])
+                    and form.get("password") == self.passwords[kaid]):
+                token = uuid.uuid4().hex
+                self.sessions[token] = (kaid, form["fkey"])
+                request["response_headers"]["Set-Cookie"] = "KAAS={}; Path=/".format(token)
+                return "<html>Welcome back!</html>"
+        raise _FakeKAError(401, "Bad username or password")
+
+    def _get_current_user(self, request):
+        return self.users[self._logged_in_user(request, check_fkey=False)]
+
+    def _get_profile(self, request):
+        query = request["query"]
+        for kaid, profile in self.users.items():
+            if (query.get("kaid") == kaid or query.get("username") == profile["username"]
+                    or query.get("email") == profile["email"]):
+                return profile
+        raise _FakeKAError(404, "No such user")
+
+    def _edit_profile(self, request):
+        data = self._json_body(request)
+        kaid = self._logged_in_user(request)
+        if data.get("kaid", kaid) != kaid:
+            raise _FakeKAError(403, "That's not you")
+
+        profile = self.users[kaid]
+        for name in ["bio", "nickname"]:
+            if name in data:
+                profile[name] = data[name]
+        return profile
+
+    # programs
+
+    def _program(self, program_id):
+        if program_id not in self.programs:
+            raise _FakeKAError(404, "No such program")
+        return self.programs[program_id]
+
+    def _get_program(self, request, program_id):
+        return self._program(program_id)
+
+    def _edit_program(self, request, program_id):
+        program = self._program(program_id)
+        self._check_author(request, program["kaid"])
+
+        data = self._json_body(request)
+        for name in ["title", "width", "height"]:
+            if name in data:
+                program[name] = data[name]
+
+        revision = data.get("revision", {})
+        image_url = revision.get("imageUrl", data.get("imageUrl"))
+        if image_url is not None:
+            program["imageUrl"] = image_url
+
+        if revision.get("code", program["revision"]["code"]) != program["revision"]["code"]:
+            program["revision"] = {
+                "id": str(next(self._ids)),
+                "code": revision["code"],
+                "created": self._now()
+            }
+        return program
+
+    def _delete_program(self, request, program_id):
+        self._check_author(request, self._program(program_id)["kaid"])
+        del self.programs[program_id]
+        for key in self.program_comments.pop(program_id):
+            self._remove_comment(key)
+        return {}
+
+    # comments
+
+    def _comment(self, key):
+        if key not in self.comments:
+            raise _FakeKAError(404, "No such comment")
+        return self.comments[key]
+
+    def _get_comments(self, request, program_id):
+        self._program(program_id)
+        query = request["query"]
+        keys = list(self.program_comments[program_id])
+        if query.get("sort") == "2": # newest first
+            keys.reverse()
+
+        # qa_expand_key puts a comment (or the comment a reply is on) first
+        expand_key = query.get("qa_expand_key")
+        if expand_key in self.comments:
+            parent = self.parents[expand_key]
+            expand_key = expand_key if parent == program_id else parent
+            if expand_key in keys:
+                keys.remove(expand_key)
+                keys.insert(0, expand_key)
+
+        start = int(query.get("cursor", 0))
+        end = start + int(query.get("limit", 10))
+        return {
+            "feedback": [self.comments[key] for key in keys[start:end]],
+            "cursor": str(end),
+            "isComplete": end >= len(keys)
+        }
+
+    def _post_comment(self, request, program_id):
+        self._program(program_id)
+        key = self.add_comment(program_id, self._json_body(request)["text"],
+            author=self._logged_in_user(request))
+        return self.comments[key]
+
+    def _edit_comment(self, request, program_id, key):
+        comment = self._comment(key)
+        self._check_author(request, comment["authorKaid"])
+        comment["content"] = self._json_body(request)["text"]
+        return comment
+
+    def _get_replies(self, request, key):
+        self._comment(key)
+        return [self.comments[reply_key] for reply_key in self.replies.get(key, [])]
+
+    def _post_reply(self, request, key):
+        self._comment(key)
+        if key not in self.replies:
+            raise _FakeKAError(400, "Replies can't be replied to")
+        reply_key = self.add_reply(key, self._json_body(request)["text"],
+            author=self._logged_in_user(request))
+        return self.comments[reply_key]
+
+    def _delete_comment(self, request, key):
+        self._check_author(request, self._comment(key)["authorKaid"])
+        parent = self.parents[key]
+        if parent in self.program_comments:
+            self.program_comments[parent].remove(key)
+        else:
+            self.replies[parent].remove(key)
+            self.comments[parent]["replyCount"] -= 1
+        self._remove_comment(key)
+        return {}
+
+    def _remove_comment(self, key):
+        for reply_key in self.replies.pop(key, []):
+            self._remove_comment(reply_key)
+        del self.comments[key]
+        del self.parents[key]
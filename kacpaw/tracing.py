@@ -0,0 +1,162 @@
+"""
+Finding out which KACPAW operations send which requests
+
+    with kacpaw.trace() as tracer:
+        reply.text_content
+
+    print(tracer.report())
+
+Every request sent while tracing is recorded as a ``RequestEvent``, along
+with the KACPAW operations (like ``ProgramCommentReply.get_metadata``) that
+caused it.  ``add_hook`` can be used instead to get a callback for each
+request.
+"""
+
+import collections
+import contextlib
+import contextvars
+import functools
+import threading
+
+RequestEvent = collections.namedtuple("RequestEvent", [
+    "operation", # the outermost operation, like "ProgramCommentReply.get_metadata"
+    "operations", # every operation we are inside of, outermost first
+    "method", "url", "status",
+    "bytes", # the size of the response body, if known
+    "seconds"
+])
+
+OperationStats = collections.namedtuple("OperationStats",
+    ["requests", "errors", "bytes", "seconds"])
+
+# The stack of operations we're in.  Context variables work with both
+# threads and asyncio tasks.
+_operations = contextvars.ContextVar("kacpaw_operations", default=())
+
+# functions that get called with a RequestEvent for each request
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """Calls ``hook(event)`` with a ``RequestEvent`` after every request"""
+    with _hooks_lock:
+        _hooks.append(hook)
+
+def remove_hook(hook):
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def operation(name):
+    """Marks requests sent inside the with block as caused by ``name``"""
+    token = _operations.set(_operations.get() + (name,))
+    try:
+        yield
+    finally:
+        _operations.reset(token)
+
+
+def traced(func):
+    """
+    Decorator for methods that marks their requests with the name of the
+    method, like ``Program.get_metadata``.  Works for classmethods too, as
+    long as ``classmethod`` is applied after this.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not _hooks: # don't slow everything down when nobody is listening
+            return func(self, *args, **kwargs)
+
+        cls = self if isinstance(self, type) else type(self)
+        with operation("{}.{}".format(cls.__name__, func.__name__)):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def record(method, url, status, size, seconds):
+    """Sends a ``RequestEvent`` to the hooks"""
+    if not _hooks:
+        return
+
+    operations = _operations.get()
+    event = RequestEvent(operations[0] if operations else None, operations,
+        method, url, status, size, seconds)
+    for hook in list(_hooks):
+        hook(event)
+
+
+def record_response(resp, *args, **kwargs):
+    """A requests response hook that records the response"""
+    if _hooks:
+        size = resp.headers.get("Content-Length")
+        record(resp.request.method, resp.url, resp.status_code,
+            None if size is None else int(size), resp.elapsed.total_seconds())
+    return resp
+
+
+def add_response_hook(session):
+    """Makes a ``requests.Session`` record its responses"""
+    if record_response not in session.hooks["response"]:
+        session.hooks["response"].append(record_response)
+
+
+class RequestBudgetError(RuntimeError):
+    """Raised by ``trace`` when more requests were sent than allowed"""
+
+
+class Tracer:
+    """Collects ``RequestEvent``s"""
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    @property
+    def request_count(self):
+        return len(self.events)
+
+    def by_operation(self):
+        """Returns a dict of operations to ``OperationStats``"""
+        totals = collections.defaultdict(lambda: [0, 0, 0, 0.0])
+        with self._lock:
+            for event in self.events:
+                total = totals[event.operation]
+                total[0] += 1
+                total[1] += event.status >= 400
+                total[2] += event.bytes or 0
+                total[3] += event.seconds
+        return {name: OperationStats(*total) for name, total in totals.items()}
+
+    def report(self):
+        """A table of ``by_operation`` as a str"""
+        row = "{:<44} {:>8} {:>7} {:>10} {:>9}"
+        lines = [row.format("operation", "requests", "errors", "bytes", "seconds")]
+        for name, stats in sorted(self.by_operation().items(),
+                key=lambda item: -item[1].requests):
+            lines.append(row.format(str(name), stats.requests, stats.errors,
+                stats.bytes, "{:.3f}".format(stats.seconds)))
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def trace(budget=None):
+    """
+    Records every request sent (from any thread) inside the with block,
+    giving a ``Tracer``.  If ``budget`` is given and more requests than that
+    are sent, ``RequestBudgetError`` is raised at the end of the block.
+    """
+    tracer = Tracer()
+    add_hook(tracer)
+    try:
+        yield tracer
+    finally:
+        remove_hook(tracer)
+
+    if budget is not None and tracer.request_count > budget:
+        raise RequestBudgetError("{} requests were sent, but the budget was {}\n{}".format(
+            tracer.request_count, budget, tracer.report()))
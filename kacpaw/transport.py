@@ -0,0 +1,131 @@
+"""
+Transports that content objects use to read from KA without being logged in
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from .cache import CacheMissError
+from .tracing import add_response_hook
+from .utils import SingleFlight
+
+
+class Transport:
+    """
+    Sends unauthenticated requests to KA.
+
+    Unlike the module-level ``requests.get``, a transport keeps its
+    connections alive in a pool, so repeated reads don't have to go through
+    a new TCP and TLS handshake each time.
+    """
+    def __init__(self, session=None, pool_size=10, retries=3,
+                 backoff_factor=0.5, retry_statuses=(500, 502, 503, 504),
+                 timeout=None, cache=None, rate_limiter=None, coalesce=True):
+        """
+        ``pool_size`` is the most connections that will be kept alive at
+        once.  If you are sending requests from a bunch of threads, make it at
+        least as big as the number of threads.
+
+        Failed GETs (connection errors and the statuses in ``retry_statuses``)
+        are retried up to ``retries`` times, sleeping ``backoff_factor * 2 **
+        (retry number - 1)`` seconds between tries.
+
+        If you already have a ``requests.Session`` (a ``KASession`` is one),
+        you can pass it as ``session`` so that reads share its connections.
+        In that case the pool and retry settings are left alone, since the
+        session is already set up the way its owner wants it.
+
+        ``cache`` can be a ``kacpaw.cache.ResponseCache`` to keep responses
+        around between runs.  Cached urls are revalidated with conditional
+        requests, and are served from the cache when KA says they haven't
+        changed.
+
+        If ``rate_limiter`` (a ``kacpaw.ratelimit.RateLimiter``) is given,
+        every request waits for it.  Pass a ``KASession``'s ``rate_limiter``
+        to keep anonymous reads inside the same budget as the session.
+
+        If ``coalesce`` is true, threads that GET the same url while a request
+        for it is already in flight wait for that request and share its
+        response instead of sending their own.  Each of them still parses the
+        json themselves, so they can't mess up each other's data.
+        """
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size,
+                max_retries=Retry(
+                    total=retries, backoff_factor=backoff_factor,
+                    status_forcelist=retry_statuses,
+                    # give us the last response so that raise_for_status can
+                    # raise the usual HTTPError
+                    raise_on_status=False
+                )
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+        add_response_hook(session)
+        self.session = session
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.coalesce = coalesce
+        self._in_flight = SingleFlight()
+
+    def get(self, url, params=None, **kwargs):
+        """Sends a GET request, returning a ``requests.Response``"""
+        kwargs.setdefault("timeout", self.timeout)
+        # requests with anything unusual (like headers or stream=True) can't
+        # be shared
+        if not self.coalesce or kwargs.keys() - {"timeout"}:
+            return self._get(url, params, **kwargs)
+
+        url = requests.Request("GET", url, params=params).prepare().url
+        return self._in_flight.do(url, self._get, url, None, **kwargs)
+
+    def _get(self, url, params=None, **kwargs):
+        if self.cache is None:
+            return self._send(url, params=params, **kwargs)
+
+        # the cache is keyed by the full url, query string and all
+        if params is not None:
+            url = requests.Request("GET", url, params=params).prepare().url
+        cached = self.cache.get(url)
+        if self.cache.offline:
+            if cached is None:
+                raise CacheMissError(url)
+            return self.cache.to_response(cached)
+
+        if cached is not None:
+            kwargs["headers"] = dict(kwargs.get("headers") or {},
+                **self.cache.conditional_headers(cached))
+
+        resp = self._send(url, **kwargs)
+        if resp.status_code == 304 and cached is not None:
+            return self.cache.to_response(cached)
+        self.cache.store(url, resp)
+        return resp
+
+    def _send(self, url, **kwargs):
+        if self.rate_limiter is None:
+            return self.session.get(url, **kwargs)
+
+        self.rate_limiter.acquire()
+        resp = self.session.get(url, **kwargs)
+        if resp.status_code in (429, 503):
+            self.rate_limiter.throttled()
+        elif resp.status_code < 500:
+            self.rate_limiter.succeeded()
+        return resp
+
+    def close(self):
+        """Closes all pooled connections"""
+        self.session.close()
+
+
+# The transport used by content unless something else is set.  Content
+# objects look at their ``transport`` attribute, so you can use a different
+# one by setting ``Content.transport`` (for everything), or the attribute on a
+# subclass or a single object.
+default_transport = Transport()
@@ -2,6 +2,10 @@
 Utility functions and constants for KACPAW
 """
 
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 KA_DOMAIN = "https://www.khanacademy.org"
 
 # An exception that indicates that something will be implemented in the future
@@ -25,12 +29,9 @@ def get_dict_path(base, path):
     For example, the dict path ``["a", "b"]`` represents the number 42 in the
     dict ``{"a": {"b": 42}}``
     """
-    path = list(path)
-    level = path.pop(0)
-
-    if path:
-        return get_dict_path(base[level], path)
-    return base[level]
+    for level in path:
+        base = base[level]
+    return base
 
 def update_dict_path(base, path, value, default=dict):
     """
@@ -42,16 +43,69 @@ def update_dict_path(base, path, value, default=dict):
     For example, the dict path ``["a", "b"]`` represents the number 42 in the
     dict ``{"a": {"b": 42}}``
     """
-    path = list(path)
-    level = path.pop(0)
-
-    if path: # we need to go at least one level deeper
-        base.setdefault(level, default())
-        update_dict_path(base[level], path, value, default)
-    else: # level is the level we are trying to set
-        base[level] = value
+    *parents, last = path
+    target = base
+    for level in parents:
+        if level not in target:
+            target[level] = default()
+        target = target[level]
+    target[last] = value
     return base # return base, now updated, for convenience
 
+def dict_paths_getter(paths):
+    """
+    Compiles a function that gets the items at several dict paths at once,
+    returning them as a tuple, like ``operator.itemgetter`` for dict paths.
+    Paths that start the same way only walk that part once, so
+    ``dict_paths_getter([["revision", "code"], ["revision", "id"]])`` is
+    about as fast as ``lambda base: (base["revision"]["code"],
+    base["revision"]["id"])``.  (Actually, that's basically what it makes,
+    the same way ``collections.namedtuple`` writes its classes.)
+    """
+    return _compile_dict_paths([tuple(path) for path in paths], single=False)
+
+def dict_path_getter(path):
+    """Like ``dict_paths_getter``, but for a single path, returning just its item"""
+    return _compile_dict_paths([tuple(path)], single=True)
+
+def _compile_dict_paths(paths, single):
+    keys = [] # the keys are passed in instead of being written into the source
+    lines = ["def get_dict_paths(base, _keys=_keys):"]
+    variables = {(): "base"}
+
+    def key(level):
+        keys.append(level)
+        return "_keys[{}]".format(len(keys) - 1)
+
+    def variable(prefix):
+        # a local variable that holds the item at prefix
+        if prefix not in variables:
+            parent = variable(prefix[:-1])
+            variables[prefix] = "_{}".format(len(variables))
+            lines.append("    {} = {}[{}]".format(variables[prefix], parent, key(prefix[-1])))
+        return variables[prefix]
+
+    items = []
+    for path in paths:
+        if not path:
+            raise ValueError("dict paths can't be empty")
+        items.append("{}[{}]".format(variable(path[:-1]), key(path[-1])))
+    lines.append("    return " + (items[0] if single else "({},)".format(", ".join(items))))
+
+    namespace = {"_keys": keys}
+    exec("\n".join(lines), namespace)
+    return namespace["get_dict_paths"]
+
+def dict_path_setter(path, default=dict):
+    """
+    Returns a function that works like ``update_dict_path(base, path, value,
+    default)`` when called as ``setter(base, value)``, for a single path.
+    """
+    path = tuple(path) # so changing the list afterwards doesn't change the setter
+    def set_dict_path(base, value):
+        return update_dict_path(base, path, value, default)
+    return set_dict_path
+
 def method(cls, name):
     """
     Decorator to make a function appear to be a method of ``cls`` with the
@@ -61,4 +115,62 @@ def method(cls, name):
         func.__name__ = name
         func.__qualname__ = ".".join([cls.__qualname__, func.__name__])
         return func
-    return decorator
\ No newline at end of file
+    return decorator
+
+def run_concurrently(func, items, workers=8):
+    """
+    Calls ``func`` on each of ``items`` using a pool of ``workers`` threads,
+    yielding the results as soon as they are ready (so not necessarily in
+    order).  ``func`` should handle its own exceptions.
+
+    Only a couple of calls per worker are queued up at a time, so huge (or
+    endless) iterables of items are fine.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(func, item)
+            for item in itertools.islice(items, workers * 2)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                pending.update(executor.submit(func, item)
+                    for item in itertools.islice(items, len(done)))
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class SingleFlight:
+    """
+    Makes concurrent calls with the same key share a single call.  While
+    ``do(key, func)`` is running, anyone else who calls ``do`` with that key
+    waits for it and gets the same result (or exception) instead of calling
+    their own ``func``.
+    """
+    def __init__(self):
+        self._calls = {} # key -> Future
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,213 @@
+"""
+Watching lots of programs for changes
+
+    watcher = kacpaw.watcher.Watcher(program_ids, rate=2)
+    watcher.on("comment", lambda event: print("New comment:", event.content.text_content))
+    watcher.run()
+
+Programs are polled on a schedule: a program that just changed is polled
+again after ``min_interval`` seconds, and every quiet poll makes the wait
+longer, up to ``max_interval``.  All requests go through one rate limiter,
+so no matter how many programs are watched, the watcher never sends more
+than ``rate`` requests per second.  It just falls behind schedule instead.
+"""
+
+import asyncio
+import collections
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from .content import Program, ProgramCommentReply
+from .ratelimit import RateLimiter
+from .transport import Transport
+
+WatchEvent = collections.namedtuple("WatchEvent", [
+    # "comment", "reply", "title", "revision" or "error"
+    "kind",
+    "program_id",
+    # the new ProgramComment or ProgramCommentReply, for "comment" and "reply"
+    "content",
+    # the old and new values for "title" and "revision" (the revision id),
+    # or the exception for "error"
+    "old", "new"
+])
+
+
+class _ProgramState:
+    # there could be thousands of these, so keep them small
+    __slots__ = ("program_id", "title", "revision", "watermark", "interval", "next_poll")
+
+    def __init__(self, program_id, interval):
+        self.program_id = program_id
+        self.title = self.revision = self.watermark = None
+        self.interval = interval
+        self.next_poll = time.monotonic()
+
+
+class Watcher:
+    """
+    Polls programs for new comments and replies, title changes and new
+    revisions of their code, giving ``WatchEvent``s to callbacks (see
+    ``on`` and ``run``) or through iteration (normal or ``async for``).
+
+    Nothing is reported the first time a program is polled, since there's
+    nothing to compare it to yet.
+    """
+    def __init__(self, program_ids=(), rate=1.0, min_interval=60, max_interval=3600,
+                 backoff=1.5, transport=None, page_size=10, watch_metadata=True):
+        """
+        ``rate`` is the most requests per second the watcher sends.  If you
+        give your own ``transport``, its ``rate_limiter`` is used instead (and
+        it should have one).  ``page_size`` is how many of the newest
+        comments are checked each poll (see ``Program.iter_new_replies``).
+        Without ``watch_metadata``, titles and revisions aren't watched, which
+        saves a request per poll.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.page_size = page_size
+        self.watch_metadata = watch_metadata
+        # a burst of 1 spreads the requests out evenly
+        self.transport = transport or Transport(rate_limiter=RateLimiter(rate, burst=1))
+
+        self._states = {}
+        self._schedule = [] # a heap of (next_poll, number, program_id)
+        self._numbers = itertools.count() # breaks ties in the heap
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        for program_id in program_ids:
+            self.add(program_id)
+
+    def add(self, program_id):
+        """Starts watching a program"""
+        with self._lock:
+            if program_id not in self._states:
+                state = self._states[program_id] = _ProgramState(program_id, self.min_interval)
+                self._push(state)
+
+    def remove(self, program_id):
+        """Stops watching a program"""
+        with self._lock:
+            # its schedule entry is skipped when it comes up
+            self._states.pop(program_id, None)
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, program_id):
+        return program_id in self._states
+
+    def _push(self, state):
+        heapq.heappush(self._schedule, (state.next_poll, next(self._numbers), state.program_id))
+
+    def on(self, kind, callback):
+        """
+        Calls ``callback(event)`` for every event of the kind ``kind`` (or
+        every event, if ``kind`` is None) while ``run`` is running.
+        """
+        self._callbacks.append((kind, callback))
+
+    def _next_due(self):
+        """Returns the state of the next program to poll, and when it's due"""
+        with self._lock:
+            while self._schedule:
+                due, _, program_id = self._schedule[0]
+                state = self._states.get(program_id)
+                if state is not None and state.next_poll == due:
+                    return state, due
+                heapq.heappop(self._schedule) # removed or rescheduled
+        return None, None
+
+    def poll_next(self):
+        """
+        Waits until the next program is due, polls it, and returns a list of
+        its events.  Returns an empty list without polling if the watcher was
+        stopped while waiting.
+        """
+        state, due = self._next_due()
+        if state is None: # nothing to watch yet
+            self._stopped.wait(self.min_interval)
+            return []
+
+        if self._stopped.wait(max(0, due - time.monotonic())):
+            return []
+
+        with self._lock:
+            if self._states.get(state.program_id) is not state or state.next_poll != due:
+                return [] # it changed while we were waiting, so try again
+            heapq.heappop(self._schedule)
+
+        try:
+            events = self._poll(state)
+        except Exception as error:
+            events = [WatchEvent("error", state.program_id, None, None, error)]
+
+        changed = any(event.kind != "error" for event in events)
+        if changed:
+            state.interval = self.min_interval
+        else:
+            state.interval = min(self.max_interval, state.interval * self.backoff)
+        # some jitter keeps programs that were added together from being
+        # polled together forever
+        state.next_poll = time.monotonic() + state.interval * random.uniform(0.9, 1.1)
+        with self._lock:
+            if self._states.get(state.program_id) is state:
+                self._push(state)
+        return events
+
+    def _poll(self, state):
+        program = Program(state.program_id)
+        program.transport = self.transport
+        events = []
+
+        if self.watch_metadata:
+            # not get_metadata, so we don't keep the code around every poll
+            fields = program.get_fields("title", "revision_id")
+            title, revision = fields["title"], fields["revision_id"]
+            if state.title is not None:
+                if title != state.title:
+                    events.append(WatchEvent("title", state.program_id, None, state.title, title))
+                if revision != state.revision:
+                    events.append(WatchEvent("revision", state.program_id, None,
+                        state.revision, revision))
+            state.title, state.revision = title, revision
+
+        new = program.iter_new_replies(since=state.watermark, page_size=self.page_size)
+        for content in new:
+            kind = "reply" if isinstance(content, ProgramCommentReply) else "comment"
+            events.append(WatchEvent(kind, state.program_id, content, None, None))
+        state.watermark = new.watermark
+        return events
+
+    def __iter__(self):
+        """Yields events until ``stop`` is called"""
+        while not self._stopped.is_set():
+            yield from self.poll_next()
+
+    async def _aiter(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopped.is_set():
+            # polling blocks, so do it in a thread
+            for event in await loop.run_in_executor(None, self.poll_next):
+                yield event
+
+    def __aiter__(self):
+        """Yields events until ``stop`` is called, without blocking the event loop"""
+        return self._aiter()
+
+    def run(self):
+        """Polls, calling the callbacks given to ``on``, until ``stop`` is called"""
+        for event in self:
+            for kind, callback in self._callbacks:
+                if kind is None or kind == event.kind:
+                    callback(event)
+
+    def stop(self):
+        """Makes ``run`` (or iteration) stop soon.  This can be called from any thread."""
+        self._stopped.set()
@@ -9,5 +9,11 @@ setup(
     description="API Wrapper for the Khan Academy Computer Programming section",
     install_requires=[
         "requests >= 2.7.0"
-    ]
+    ],
+    extras_require={
+        # lets get_fields parse big responses as they're downloaded
+        "streaming": ["ijson"],
+        # for kacpaw.aio
+        "async": ["aiohttp"]
+    }
 )
\ No newline at end of file
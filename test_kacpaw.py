@@ -1,10 +1,20 @@
 # Tests for KACPAW
 
 import pytest
+import kacpaw
 from kacpaw import *
+from kacpaw.testing import FakeKA
+from kacpaw.utils import run_concurrently
+import kacpaw.handles
+import kacpaw.watcher
 
 
+import asyncio
+import io
 import os
+import json
+import time
+import threading
 import sys
 import getpass
 from pprint import pprint
@@ -15,6 +25,15 @@ from operator import attrgetter, methodcaller
 BOT_TEST_PROGRAM_ID = "4617827881975808"
 PROGRAM_ID = os.environ.get("KACPAW_TEST_PROGRAM_ID", BOT_TEST_PROGRAM_ID)
 
+# Set KACPAW_TEST_CACHE to a file to keep KA's responses around between runs.
+# If KACPAW_TEST_OFFLINE is also set, only cached responses are used, so the
+# tests that don't need a session can run without a network connection.
+if "KACPAW_TEST_CACHE" in os.environ:
+    abcs.Content.transport = Transport(cache=ResponseCache(
+        os.environ["KACPAW_TEST_CACHE"],
+        offline="KACPAW_TEST_OFFLINE" in os.environ
+    ))
+
 program = Program(PROGRAM_ID) # this is a general-purpose program that you can set
 bot_test_program = Program(BOT_TEST_PROGRAM_ID) # This is my KA API Bot Test program
 
@@ -45,6 +64,18 @@ def test_bot_test_program():
 
     assert bot_test_program.kind == "pjs"
 
+def test_metadata_cache():
+    test_program = Program(BOT_TEST_PROGRAM_ID)
+    metadata = test_program.get_metadata()
+    assert test_program.get_metadata() is metadata # cached
+
+    assert test_program.refresh() is not metadata
+    test_program.invalidate()
+    assert test_program.get_metadata() is not metadata
+
+    test_program.metadata_ttl = 0
+    assert test_program.get_metadata() is not test_program.get_metadata()
+
 def test_edit_program(session):
     with open("README.rst") as readme:
         program.edit(session, 
@@ -128,6 +159,735 @@ def test_deleted_comments(session):
     with pytest.raises(requests.HTTPError):
         comment.get_metadata()
 
+def test_response_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_size=25)
+    cache.put("https://example.com/a", b"0123456789", etag='"a"')
+    cache.put("https://example.com/b", b"0123456789")
+    assert cache.get("https://example.com/a").etag == '"a"' # a is now newer than b
+
+    cache.put("https://example.com/c", b"0123456789")
+    assert cache.get("https://example.com/b") is None # least recently used
+    assert len(cache) == 2 and cache.size() == 20
+
+    resp = cache.to_response(cache.get("https://example.com/a"))
+    assert resp.content == b"0123456789" and resp.headers["ETag"] == '"a"'
+
+    offline_transport = Transport(cache=ResponseCache(":memory:", offline=True))
+    with pytest.raises(requests.ConnectionError):
+        offline_transport.get("https://example.com/a")
+
+def test_meta_getters():
+    metadata = {"title": "T", "revision": {"code": "C", "imageUrl": "I"}}
+    assert Program.meta_getter("code", "title", "image_url")(metadata) == ("C", "T", "I")
+    assert Program.meta_getter("title") is Program.meta_getter("title")
+    with pytest.raises(KeyError):
+        Program.meta_getter("width")(metadata)
+
+    Program._meta_setters["code"](metadata, "new code")
+    assert metadata["revision"]["code"] == "new code"
+    assert kacpaw.utils.update_dict_path({}, ["a", "b"], 1) == {"a": {"b": 1}}
+
+def test_handles():
+    program = Program("4617827881975808")
+    comment = ProgramComment("kaencrypted_comment", program)
+    reply = ProgramCommentReply("kaencrypted_reply", comment)
+
+    assert kacpaw.handles.handle(comment) == comment
+    assert kacpaw.handles.handle(reply) in {reply}
+    assert isinstance(kacpaw.handles.handle(reply).content(), ProgramCommentReply)
+    assert kacpaw.handles.ProgramHandle(program.id).content() == program
+
+    comments = kacpaw.handles.ProgramCommentSet([comment, reply])
+    assert not comments.add(kacpaw.handles.handle(comment))
+    for number in range(1000):
+        assert comments.add_key("kaencrypted_{}".format(number), "1234")
+    assert comments.add_key("no_prefix", program.id)
+
+    assert len(comments) == 1003
+    assert "kaencrypted_500" in comments and reply in comments
+    assert "kaencrypted_1000" not in comments
+    assert {"kaencrypted_reply", "no_prefix"} <= set(comments.keys())
+    assert list(comments)[:2] == [comment, reply]
+
+    # real keys look like the one in test_reply_reply: 429 characters
+    def real_key(number):
+        digest = "{:064x}".format(number * 0x9e3779b97f4a7c15)
+        return "kaencrypted_{}_{}".format(digest[:32], digest * 6)
+    keys = [real_key(number) for number in range(1000)]
+    real_comments = kacpaw.handles.ProgramCommentSet()
+    for key in keys:
+        assert real_comments.add_key(key, "1234")
+    assert len(keys[0]) == 429 and len(real_comments) == 1000
+    assert list(real_comments.keys()) == keys
+    assert keys[500] in real_comments and real_key(1000) not in real_comments
+    assert real_comments.memory_size() < 250 * len(real_comments)
+
+    # keys that aren't hex still work
+    assert real_comments.add_key("kaencrypted_ABC_xyz_1", "1234")
+    assert "kaencrypted_ABC_xyz_1" in real_comments
+    assert list(real_comments.keys())[-1] == "kaencrypted_ABC_xyz_1"
+
+########## offline tests against kacpaw.testing.FakeKA ##########
+
+@pytest.fixture(scope="module")
+def fake_ka():
+    with FakeKA() as fake:
+        fake.add_user("fake_bot", "password")
+        yield fake
+
+@pytest.fixture
+def fake_transport(fake_ka):
+    transport = fake_ka.install(Transport())
+    old_transport = abcs.Content.transport
+    abcs.Content.transport = transport
+    yield transport
+    abcs.Content.transport = old_transport
+
+@pytest.fixture
+def fake_session(fake_ka):
+    return fake_ka.session("fake_bot", "password")
+
+def test_fake_comments(fake_ka, fake_transport, fake_session):
+    fake_program = Program(fake_ka.add_program(author=fake_session.user_id))
+    comment = fake_program.reply(fake_session, "A comment")
+    assert comment.text_content == "A comment"
+
+    reply = comment.reply(fake_session, "A reply")
+    assert reply.text_content == "A reply"
+    assert reply.reply(fake_session, "Reply reply").text_content == "@fake_bot: Reply reply"
+
+    reply.edit(fake_session, "Edited")
+    assert reply.text_content == "Edited"
+
+    reply.delete(fake_session)
+    with pytest.raises(requests.HTTPError):
+        reply.text_content
+
+    comment.delete(fake_session)
+    with pytest.raises(requests.HTTPError):
+        comment.text_content
+
+def test_fake_request_counts(fake_ka, fake_transport):
+    fake_program = Program(fake_ka.add_program(comments=25, replies=5))
+
+    fake_ka.reset_requests()
+    fake_program.title, fake_program.code, fake_program.width
+    assert fake_ka.request_count == 1
+
+    fake_ka.reset_requests()
+    comment = next(fake_program.get_replies())
+    assert [reply.text_content for reply in comment.get_replies()] == [
+        "Reply {}".format(number) for number in range(5)]
+    assert fake_ka.request_count == 2 # a page of comments and the thread
+
+def test_projection():
+    data = {"title": "T", "revision": {"code": "C", "tags": [1, {"a": None}]}, "n": 1.5}
+    paths = {"title": ["title"], "tags": ["revision", "tags"], "n": ["n"],
+        "missing": ["revision", "nope"], "too_deep": ["title", "x"]}
+    expected = {"title": "T", "tags": [1, {"a": None}], "n": 1.5,
+        "missing": None, "too_deep": None}
+    assert kacpaw.projection.project(data, paths) == expected
+
+    pytest.importorskip("ijson")
+    stream = io.BytesIO(json.dumps(data).encode("utf-8"))
+    assert kacpaw.projection._project_stream(stream, paths) == expected
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_fake_fields(fake_ka, fake_transport, monkeypatch, streaming):
+    if streaming:
+        pytest.importorskip("ijson")
+        monkeypatch.setattr(kacpaw.projection, "STREAMING_THRESHOLD", 0)
+    else:
+        monkeypatch.setattr(kacpaw.projection, "ijson", None)
+
+    program_id = fake_ka.add_program(title="Fields", code="rect(0, 0, 10, 10);")
+    expected = {"title": "Fields", "code": "rect(0, 0, 10, 10);",
+        "image_url": fake_ka.programs[program_id]["imageUrl"]}
+
+    # fetch_fields finds image_url where it is in the raw response
+    fake_ka.reset_requests()
+    program = Program(program_id)
+    assert program.get_fields("title", "code", "image_url") == expected
+    assert program.fetch_fields(["title", "code", "image_url"]) == expected
+    assert fake_ka.request_count == 2 and not program.loaded
+
+    # with metadata cached, get_fields doesn't send anything
+    program.load()
+    fake_ka.reset_requests()
+    assert program.get_fields("title", "code", "image_url") == expected
+    assert fake_ka.request_count == 0
+
+    with pytest.raises(KeyError):
+        program.get_fields("nope")
+
+def test_fake_fields_connections(fake_ka, monkeypatch):
+    pytest.importorskip("ijson")
+    monkeypatch.setattr(kacpaw.projection, "STREAMING_THRESHOLD", 0)
+    monkeypatch.setattr(kacpaw.projection, "DRAIN_LIMIT", 256 * 1024)
+    # both are big enough that urllib3 won't have read the rest on its own
+    small_id = fake_ka.add_program(title="Small", code="// code\n" * 10000)
+    big_id = fake_ka.add_program(title="Big", code="// code\n" * 100000)
+
+    def fetch_urls(program_id, transport):
+        for _ in range(3):
+            program = Program(program_id)
+            program.transport = transport
+            assert program.fetch_fields(["url"])["url"].endswith(program_id)
+
+    # the rest of a small response is read, so the connection is kept alive
+    connections = fake_ka.connections
+    fetch_urls(small_id, fake_ka.install(Transport()))
+    assert fake_ka.connections == connections + 1
+
+    # but reading all of a big one would take longer than a new connection
+    connections = fake_ka.connections
+    fetch_urls(big_id, fake_ka.install(Transport()))
+    assert fake_ka.connections == connections + 3
+
+def test_fake_pagination(fake_ka, fake_transport):
+    program = Program(fake_ka.add_program(comments=25))
+    texts = ["Comment {}".format(number) for number in range(25)]
+
+    for prefetch in [False, True]:
+        fake_ka.reset_requests()
+        paginator = program.paginate_replies(page_size=10, prefetch=prefetch)
+        assert [data["content"] for data in paginator] == texts
+        assert paginator.complete and paginator.cursor is None
+        assert paginator.pages_fetched == fake_ka.request_count == 3
+
+    # max_items stops early, without prefetching a page it won't use
+    fake_ka.reset_requests()
+    paginator = program.paginate_replies(page_size=10, max_items=15, prefetch=True)
+    assert [data["content"] for data in paginator] == texts[:15]
+    assert fake_ka.request_count == 2 and not paginator.complete
+
+    fake_ka.reset_requests()
+    assert list(program.paginate_replies(max_items=0)) == []
+    assert fake_ka.request_count == 0
+
+    # resuming from the cursor picks up at the page we stopped on
+    paginator = program.paginate_replies(page_size=10)
+    assert [next(paginator)["content"] for _ in range(12)] == texts[:12]
+    resumed = program.paginate_replies(page_size=10, cursor=paginator.cursor)
+    assert [data["content"] for data in resumed] == texts[10:]
+
+def test_fake_comment_exists(fake_ka, fake_transport):
+    program_id = fake_ka.add_program(comments=3)
+    program = Program(program_id)
+    key = fake_ka.program_comments[program_id][1]
+
+    # KA puts the comment first, so we know it exists
+    fake_ka.reset_requests()
+    assert ProgramComment(key, program).text_content == "Comment 1"
+    assert fake_ka.request_count == 1
+
+    # KA gives the normal first page, so we have to check
+    fake_ka.reset_requests()
+    with pytest.raises(requests.HTTPError):
+        ProgramComment("kaencrypted_missing", program).text_content
+    assert fake_ka.request_count == 2
+
+    # without the check, we get the wrong comment, but only send one request
+    fake_ka.reset_requests()
+    missing = ProgramComment("kaencrypted_missing", program)
+    missing.check_exists = False
+    assert missing.text_content == "Comment 0"
+    assert fake_ka.request_count == 1
+
+def test_fake_trace(fake_ka, fake_transport):
+    program_id = fake_ka.add_program(comments=3, replies=3)
+    reply_key = fake_ka.replies[fake_ka.program_comments[program_id][0]][-1]
+
+    with kacpaw.trace() as tracer:
+        ProgramCommentReply(reply_key, Program(program_id)).text_content
+        list(Program(program_id).get_reply_data(page_size=2))
+
+    stats = tracer.by_operation()
+    assert stats["ProgramCommentReply.get_metadata"].requests == 3
+    assert stats["Program.get_reply_data page"].requests == 2
+
+    with pytest.raises(kacpaw.tracing.RequestBudgetError):
+        with kacpaw.trace(budget=0):
+            Program(program_id).title
+
+def test_fake_edit_many(fake_ka, fake_transport, fake_session):
+    program_ids = [fake_ka.add_program(title="Old", author=fake_session.user_id)
+        for _ in range(5)]
+    programs = [result.content for result in Program.fetch_many(program_ids)]
+
+    fake_ka.reset_requests()
+    edits = [(program, {"title": "New" if number % 2 else "Old"})
+        for number, program in enumerate(programs)]
+    results = list(abcs.edit_many(fake_session, edits, workers=3))
+    assert all(result.ok for result in results)
+    assert sum(result.changed for result in results) == 2
+    assert fake_ka.request_count == 2 # the metadata was cached, and 3 edits did nothing
+
+    assert sorted(Program(program_id).title for program_id in program_ids) == ["New"] * 2 + ["Old"] * 3
+
+def test_fake_throttling():
+    with FakeKA(error_rate=0.3, error_status=429, retry_after=0, seed=0) as fake:
+        fake.add_user("fake_bot", "password")
+        program_id = fake.add_program()
+
+        session = fake.session("fake_bot", "password",
+            rate_limiter=kacpaw.ratelimit.RateLimiter(rate=1000), max_retries=20)
+        for _ in range(20):
+            session.get(Program(program_id).api_get).raise_for_status()
+
+        stats = session.stats()
+        assert stats["throttled"] == stats["retries"] > 0
+        assert stats["rate"] < 1000
+
+        # without a rate limiter, requests are still retried
+        session = fake.session("fake_bot", "password", max_retries=20)
+        assert session.rate_limiter is None
+        for _ in range(20):
+            session.get(Program(program_id).api_get).raise_for_status()
+        assert list(session.stats()) == ["retries"] and session.retry_count > 0
+
+def test_fake_user_data(fake_ka):
+    kaid = fake_ka.add_user("data_bot", "password", nickname="Data Bot")
+    session = fake_ka.session("data_bot", "password")
+
+    fake_ka.reset_requests()
+    for _ in range(5):
+        assert session.user_id == kaid
+        assert session.user_data["nickname"] == "Data Bot"
+    assert fake_ka.request_count == 0
+
+def test_fake_user_lookups(fake_ka, fake_transport, tmp_path):
+    kaids = {name: fake_ka.add_user(name, bio="I'm " + name) for name in ["alice", "bob", "carol"]}
+    User.identifier_cache = IdentifierCache(
+        max_size=2, path=str(tmp_path / "identifiers.sqlite"))
+    try:
+        fake_ka.reset_requests()
+        users = User.from_usernames(["alice", "bob", "alice", "carol", "nobody_at_all"])
+        assert {name: result.content.id for name, result in users.items() if result.ok} == kaids
+        assert users["nobody_at_all"].error.response.status_code == 404
+        assert users["bob"].content.bio == "I'm bob" # the profile is already the metadata
+        assert users["bob"].metadata["bio"] == "I'm bob"
+        assert fake_ka.request_count == 4
+
+        # one lookup failing doesn't lose the others
+        class FlakyUser(User):
+            @classmethod
+            def _download_profile(cls, identifier_kind, identifier):
+                if identifier == "broken":
+                    raise requests.ConnectionError("oops")
+                return super()._download_profile(identifier_kind, identifier)
+        users = FlakyUser.from_usernames(["broken", "alice"])
+        assert isinstance(users["broken"].error, requests.ConnectionError)
+        assert users["alice"].content.id == kaids["alice"]
+
+        # carol was pushed out of memory, but she's still in the database
+        assert User.from_username("ALICE").id == kaids["alice"]
+        assert User.from_username("carol").id == kaids["carol"]
+        assert fake_ka.request_count == 4
+    finally:
+        User.identifier_cache.close()
+        User.identifier_cache = IdentifierCache()
+
+def test_fake_export(fake_ka, fake_transport, tmp_path):
+    program = Program(fake_ka.add_program(comments=25, replies=3))
+    path = str(tmp_path / "discussion.jsonl")
+    assert kacpaw.export.export_to_file(program, path, page_size=10) == 100
+
+    with open(path) as file:
+        lines = [json.loads(line) for line in file]
+    items = [line for line in lines if line["type"] != "checkpoint"]
+    comment_keys = {item["key"] for item in items if item["type"] == "comment"}
+    assert len(comment_keys) == 25
+    assert all(item["parent"] in comment_keys for item in items if item["type"] == "reply")
+    assert lines[-1] == {"type": "checkpoint", "cursor": None, "complete": True}
+    assert kacpaw.export.export_to_file(program, path) == 0 # nothing left to do
+
+    # pretend we got interrupted in the middle of the second page
+    first_checkpoint = next(i for i, line in enumerate(lines) if line["type"] == "checkpoint")
+    with open(path, "w") as file:
+        for line in lines[:first_checkpoint + 20]:
+            file.write(json.dumps(line) + "\n")
+        file.write('{"type": "rep')
+
+    # some of the second page's comments might have been written before the
+    # checkpoint, so they aren't written again
+    assert 0 < kacpaw.export.export_to_file(program, path, page_size=10) <= 60
+    with open(path) as file:
+        resumed = [json.loads(line) for line in file]
+    assert sorted(line["key"] for line in resumed if "key" in line) == sorted(
+        item["key"] for item in items)
+
+def test_export_skip_checkpoints():
+    class Pages: # stands in for a Paginator
+        pages = [("P1", ["a1", "a2"]), ("P2", ["b1", "b2"]), ("P3", ["c1", "c2"])]
+
+        def __init__(self, cursor):
+            self.cursor, self.complete = cursor, False
+
+        def __iter__(self):
+            start = [cursor for cursor, _ in self.pages].index(self.cursor)
+            for self.cursor, keys in self.pages[start:]:
+                for key in keys:
+                    yield {"key": key}
+            self.cursor, self.complete = None, True
+
+    # resuming at P2, where b2 and c1 were written before we got interrupted
+    fp = io.StringIO()
+    written = kacpaw.export.write_discussion(fp, "program", Pages("P2"), None,
+        workers=1, skip=["b2", "c1"])
+    lines = [json.loads(line) for line in fp.getvalue().splitlines()]
+    assert written == 2 and [line["key"] for line in lines if "key" in line] == ["b1", "c2"]
+
+    # c1 has to stay done, or resuming from P3 would write it again
+    checkpoints = [line for line in lines if line["type"] == "checkpoint" and line["cursor"]]
+    assert checkpoints and all(line["cursor"] == "P3" for line in checkpoints)
+    assert all("c1" in line["done"] for line in checkpoints)
+
+def test_fake_new_replies(fake_ka, fake_transport):
+    program_id = fake_ka.add_program(comments=15, replies=2)
+    program = Program(program_id)
+
+    fake_ka.reset_requests()
+    new = program.iter_new_replies()
+    assert list(new) == []
+    watermark = Watermark(**json.loads(json.dumps(new.watermark._asdict())))
+    assert fake_ka.request_count == 1
+
+    new = program.iter_new_replies(since=watermark)
+    assert list(new) == [] and new.watermark == watermark
+    assert fake_ka.request_count == 2 # nothing changed, so just one more
+
+    old_key = fake_ka.program_comments[program_id][-1]
+    fake_ka.add_reply(old_key, "New reply on an old comment")
+    new_key = fake_ka.add_comment(program_id, "New comment")
+    fake_ka.add_reply(new_key, "New reply on a new comment")
+
+    fake_ka.reset_requests()
+    new = program.iter_new_replies(since=watermark)
+    assert [item.text_content for item in new] == [
+        "New comment", "New reply on a new comment", "New reply on an old comment"]
+    # two threads, and two pages, since the new comment pushed a watched one
+    # onto the second page
+    assert fake_ka.request_count == 4
+    assert new.watermark.threads[new_key] == 1
+
+def test_fake_new_replies_empty(fake_ka, fake_transport):
+    program_id = fake_ka.add_program()
+    program = Program(program_id)
+    new = program.iter_new_replies()
+    assert list(new) == []
+    assert new.watermark == Watermark(None, {})
+
+    # more comments than are watched, with no seen comments to stop at
+    keys = [fake_ka.add_comment(program_id, "Comment {}".format(i)) for i in range(25)]
+    new = program.iter_new_replies(since=new.watermark)
+    assert sorted(comment.id for comment in new) == sorted(keys)
+    assert list(program.iter_new_replies(since=new.watermark)) == []
+
+def test_fake_watcher(fake_ka):
+    quiet_id = fake_ka.add_program(comments=3)
+    busy_id = fake_ka.add_program(comments=3)
+    watcher = kacpaw.watcher.Watcher([quiet_id, busy_id], rate=1000,
+        min_interval=0.01, max_interval=10, backoff=100,
+        transport=fake_ka.install(Transport()))
+    watcher.transport.rate_limiter = kacpaw.ratelimit.RateLimiter(1000)
+
+    assert watcher.poll_next() == watcher.poll_next() == [] # first polls just look
+    fake_ka.add_comment(busy_id, "Hello")
+    fake_ka.programs[busy_id]["title"] = "Renamed"
+    fake_ka.programs[busy_id]["revision"]["id"] = "new revision"
+
+    events = watcher.poll_next() + watcher.poll_next()
+    assert {event.program_id for event in events} == {busy_id}
+    assert sorted(event.kind for event in events) == ["comment", "revision", "title"]
+    assert [event.new for event in events if event.kind == "title"] == ["Renamed"]
+
+    seen = []
+    watcher.on("comment", seen.append)
+    watcher.on("comment", lambda event: watcher.stop())
+    fake_ka.add_comment(busy_id, "Hello again")
+    threading.Timer(5, watcher.stop).start() # just in case
+    watcher.run()
+    assert [event.content.text_content for event in seen] == ["Hello again"]
+
+def test_fake_watcher_empty(fake_ka):
+    program_id = fake_ka.add_program()
+    watcher = kacpaw.watcher.Watcher([program_id], min_interval=0,
+        transport=fake_ka.install(Transport()), page_size=10)
+    watcher.transport.rate_limiter = kacpaw.ratelimit.RateLimiter(1000)
+
+    assert watcher.poll_next() == [] # no comments yet
+    keys = [fake_ka.add_comment(program_id, "Comment {}".format(i)) for i in range(25)]
+    events = watcher.poll_next()
+    assert sorted(event.content.id for event in events) == sorted(keys)
+    assert watcher.poll_next() == []
+
+def test_fake_coalescing():
+    with FakeKA(latency=0.2) as fake:
+        program_id = fake.add_program(comments=1, replies=5)
+        transport = fake.install(Transport())
+        program = Program(program_id)
+        program.transport = transport
+        comment_key = fake.program_comments[program_id][0]
+
+        def read(_):
+            metadata = Program(program_id).get_metadata()
+            metadata["title"] = "Mine" # nobody else should see this
+            return ProgramComment(comment_key, program).get_thread()
+
+        Program.transport = transport
+        try:
+            threads = list(run_concurrently(read, range(8)))
+        finally:
+            del Program.transport
+        assert fake.request_count == 2 # one for the metadata, one for the thread
+        assert len({id(thread.replies) for thread in threads}) == 8
+        assert program.title == "Fake Program"
+
+def test_aio_content(monkeypatch):
+    # none of this sends requests, so it doesn't need aiohttp
+    from kacpaw.aio import AsyncProgram, AsyncProgramComment
+    monkeypatch.setattr(AsyncProgram, "unloaded", "raise")
+
+    async def check():
+        program = AsyncProgram("123")
+        program._cache_metadata({"title": "T", "url": "https://example.com/123",
+            "revision": {"code": "C", "imageUrl": "I"}})
+        assert await program.title == "T"
+        assert await program.get_fields("code", "image_url") == {"code": "C", "image_url": "I"}
+        assert await program.prefetch("title") is program
+        # like the sync edits, no-op edits aren't sent (there's no session to send them)
+        assert await program.edit(None, title="T", code="C") is False
+
+        # the comment's url comes from a program that isn't loaded
+        comment = AsyncProgramComment("kaencrypted_comment", program)
+        with pytest.raises(abcs.NotLoadedError):
+            await comment.url
+
+        comment.unloaded = "stale"
+        comment._cache_metadata({"content": "Hi"}, fetched=-1000)
+        assert not comment.loaded and await comment.text_content == "Hi"
+        comment._cache_metadata({"content": "Hi"})
+        assert await comment.edit(None, "Hi") is False
+
+        for name in ["paginate_replies", "export_discussion", "iter_new_replies"]:
+            with pytest.raises(NotImplementedError):
+                getattr(program, name)()
+
+    asyncio.run(check())
+
+def test_fake_aio(fake_ka, monkeypatch):
+    pytest.importorskip("aiohttp")
+    from kacpaw.aio import (
+        AsyncContent, AsyncTransport, AsyncKASession, AsyncUser, AsyncProgram,
+        AsyncProgramCommentReply
+    )
+    kaid = fake_ka.add_user("async_bot", "password")
+    program_id = fake_ka.add_program(author=kaid, comments=3, replies=2)
+
+    async def check():
+        transport = fake_ka.install(AsyncTransport())
+        monkeypatch.setattr(AsyncContent, "transport", transport)
+        session = fake_ka.install(AsyncKASession("async_bot", "password"))
+        async with transport, session: # logs in, with html login pages
+            assert session.user.id == kaid
+
+            program = AsyncProgram(program_id)
+            assert await program.title == "Fake Program"
+            comments = [comment async for comment in program.get_replies()]
+            assert [await comment.text_content for comment in comments] == [
+                "Comment 0", "Comment 1", "Comment 2"]
+            assert await comments[0].url == "{}?qa_expand_key={}".format(
+                fake_ka.programs[program_id]["url"], comments[0].id)
+
+            replies = [reply async for reply in comments[0].get_replies()]
+            assert [await reply.text_content for reply in replies] == ["Reply 0", "Reply 1"]
+            reply = AsyncProgramCommentReply(replies[0].id, program) # parent unknown
+            assert await reply.text_content == "Reply 0"
+            assert [data["key"] async for data in reply.get_reply_data()] == [replies[1].id]
+
+            comment = await program.reply(session, "Async comment")
+            assert await comment.text_content == "Async comment"
+            await comment.delete(session)
+
+            results = [result async for result in
+                AsyncProgram.fetch_many([program_id, "404"], fields=["title"])]
+            assert sorted(result.ok for result in results) == [False, True]
+            assert next(result.metadata for result in results if result.ok) == {
+                "title": "Fake Program"}
+
+            users = await AsyncUser.from_usernames(["async_bot", "nobody"])
+            assert users["async_bot"].content.id == kaid
+            assert users["nobody"].error.status == 404
+
+    asyncio.run(check())
+
+def test_fake_unloaded(fake_ka, fake_transport):
+    program = Program(fake_ka.add_program(title="Lazy", code="// lazy"))
+    program.unloaded = "raise"
+    fake_ka.reset_requests()
+
+    assert not hasattr(program, "title") and not program.loaded
+    with pytest.raises(abcs.NotLoadedError):
+        program.code
+    assert fake_ka.request_count == 0
+
+    assert program.prefetch("title").title == "Lazy"
+    with pytest.raises(abcs.NotLoadedError):
+        program.code # not prefetched
+    assert program.load().code == "// lazy" and program.loaded
+    assert fake_ka.request_count == 2
+
+    # stale metadata is better than nothing
+    program.unloaded = "stale"
+    program.metadata_ttl = 0.01
+    time.sleep(0.02)
+    assert program.title == "Lazy"
+    assert fake_ka.request_count == 2
+
+def test_fake_moderation(fake_ka, fake_transport):
+    from kacpaw.moderation import Moderator, discussion, by_author, matches, older_than
+
+    spammer = fake_ka.add_user("spammer", "password")
+    program_id = fake_ka.add_program(comments=3, replies=1)
+    for key in list(fake_ka.program_comments[program_id]):
+        fake_ka.add_reply(key, "FREE stuff at example.com", author=spammer)
+    fake_ka.add_comment(program_id, "free stuff", author=spammer)
+    fake_ka.add_comment(program_id, "Not spam", author=spammer)
+    session = fake_ka.session("spammer", "password")
+    program = Program(program_id)
+
+    fake_ka.reset_requests()
+    spam = [by_author(spammer), matches(r"free stuff"), older_than(days=1)]
+    report = Moderator(session, spam, dry_run=True).run(discussion(program))
+    assert report.checked == 11 and len(report.succeeded) == 4
+    assert fake_ka.request_count == 4 # a page of comments and 3 threads
+
+    fake_ka.reset_requests()
+    report = Moderator(session, spam).run(discussion(program))
+    assert len(report.succeeded) == 4 and not report.failed
+    assert fake_ka.request_count == 4 + 4
+    assert [comment.text_content for comment in discussion(program)] == [
+        "Comment 0", "Reply 0", "Comment 1", "Reply 0", "Comment 2", "Reply 0", "Not spam"]
+
+    # the spammer can't delete other people's comments
+    report = Moderator(session, [matches("Reply")]).run(discussion(program))
+    assert len(report.failed) == 3 and "3 failed" in report.summary()
+
+    # deleting comments deletes their replies, so those aren't deleted again
+    spam_program = Program(fake_ka.add_program())
+    for number in range(8):
+        key = fake_ka.add_comment(spam_program.id, "free stuff {}".format(number), author=spammer)
+        fake_ka.add_reply(key, "more free stuff", author=spammer)
+    report = Moderator(session, spam, dry_run=True).run(discussion(spam_program))
+    assert report.checked == 16 and len(report.results) == 8
+    report = Moderator(session, spam, workers=1).run(discussion(spam_program))
+    assert report.checked == 16 and not report.errors
+    assert len(report.succeeded) == 8 and not report.failed
+    assert fake_ka.program_comments[spam_program.id] == []
+
+    # if going through the comments fails, we still get a report
+    def broken_discussion():
+        yield from discussion(program)
+        raise requests.HTTPError("oops")
+    report = Moderator(session, spam).run(broken_discussion())
+    assert report.checked == 7 and len(report.errors) == 1
+    assert "stopped early" in report.summary()
+
+    # neither does a predicate raising on one comment
+    keys = [fake_ka.add_comment(spam_program.id, "free stuff", author=spammer) for _ in range(4)]
+    fake_ka.comments[keys[1]]["date"] = "yesterday"
+    report = Moderator(session, spam, workers=1).run(discussion(spam_program))
+    assert report.checked == 4 and len(report.succeeded) == 3
+    failed, = report.failed
+    assert failed.action == "check" and isinstance(failed.error, ValueError)
+    assert "3 matched" in report.summary()
+    assert fake_ka.program_comments[spam_program.id] == [keys[1]]
+
+def test_fake_revisions(fake_ka, fake_transport, tmpdir):
+    from kacpaw.revisions import RevisionStore
+
+    code = "".join("var line{} = {};\n".format(i, i) for i in range(200))
+    program_id = fake_ka.add_program(code=code)
+    spinoff_id = fake_ka.add_program(code=code)
+    path = str(tmpdir.join("revisions"))
+    pack = tmpdir.join("revisions", "blobs.pack")
+
+    with RevisionStore(path) as store:
+        assert store.snapshot_many([program_id, spinoff_id], when=100) == {
+            program_id: True, spinoff_id: True}
+        size = pack.size() # the spin-off's code is only stored once
+
+        # snapshotting again doesn't store anything
+        assert store.snapshot(Program(program_id), when=200) is False
+        assert pack.size() == size
+
+        changed = code.replace("line100 = 100", "line100 = 'changed'")
+        fake_ka.programs[program_id]["revision"]["code"] = changed
+        assert store.snapshot(Program(program_id), when=300) is True
+        assert pack.size() - size < 100 # just a delta
+        assert store.changed_since(250) == [program_id]
+        assert sorted(store.changed_since(0)) == sorted([program_id, spinoff_id])
+
+    # everything can be read back after reopening the store
+    with RevisionStore(path) as store:
+        (first_time, first), (second_time, second) = store.history(program_id)
+        assert (first_time, second_time) == (100, 300)
+        assert store.code(first) == code and store.code(second) == changed
+        assert store.latest(program_id) == second and store.latest(spinoff_id) == first
+
+def test_fake_saved_session(fake_ka, fake_transport, tmpdir):
+    kaid = fake_ka.add_user("saved_bot", "password")
+    program_id = fake_ka.add_program(author=kaid)
+    path = str(tmpdir.join("session.json"))
+    fake_ka.session("saved_bot", "password").save(path)
+
+    fake_ka.reset_requests()
+    session = fake_ka.install(KASession.load(path, "saved_bot", "password"))
+    assert session.user.id == kaid
+    assert fake_ka.request_count == 0
+
+    program = Program(program_id)
+    program.transport = fake_ka.install(kacpaw.Transport())
+    program.edit(session, title="Saved")
+    assert fake_ka.request_count == 2 # no logging in
+
+    # when the saved login expires, the session logs in again
+    fake_ka.expire_sessions()
+    program.edit(session, title="Expired")
+    assert program.title == "Expired"
+
+    # even if lots of threads find out at once, it only logs in once
+    fake_ka.expire_sessions()
+    fake_ka.reset_requests()
+    titles = ["Thread {}".format(number) for number in range(4)]
+    list(run_concurrently(lambda title: Program(program_id).edit(session, title=title), titles, 4))
+    assert fake_ka.requests.count(("POST", "/login")) == 1
+
+    # but being forbidden from something isn't a reason to log in again
+    other_program = Program(fake_ka.add_program())
+    fake_ka.reset_requests()
+    with pytest.raises(requests.HTTPError):
+        other_program.edit(session, title="Not mine")
+    assert fake_ka.request_count == 2 # the metadata and the edit
+    def forbidden(body):
+        resp = requests.Response()
+        resp.status_code, resp._content = 403, body.encode()
+        return resp
+    assert session._needs_login(forbidden("Bad fkey"))
+    assert not session._needs_login(forbidden('Forbidden. <a href="/login">Log in</a>'))
+
+    # and without the password, it can't
+    fake_ka.expire_sessions()
+    session = fake_ka.install(KASession.load(path))
+    with pytest.raises(requests.HTTPError):
+        program.edit(session, title="Nope")
+
+def test_fake_request_budgets(fake_ka):
+    from bench_kacpaw import Benchmarks
+    for result in Benchmarks(fake_ka, comments=30, replies=5).run_all(repeat=2):
+        assert result.requests_per_op <= result.budget, result.name
+
 def test_users():
     pass
 